@@ -1,97 +1,197 @@
 #!/bin/env python3
+#
+# Boil Rekognition's label detections down to sightings:  runs of the same
+# label with no gap longer than --gap, which last at least --length and
+# have an average confidence of at least --confidence.
+#
+# The labels are read into columns (timestamp, confidence, label id) --
+# streamed with ijson when it's installed -- and the sightings are found
+# with array operations over all of the labels at once.  Give it a
+# directory instead of a file to aggregate every Rekognition labels file
+# in it, in parallel.
+#
+
 import argparse
-import yaml
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 import json
+import multiprocessing
+import os
+from pathlib import Path
+import yaml
+from yaml import CSafeDumper as Dumper
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class Labels:
+    """The label detections as columns.  Each distinct (category, name,
+       parents) is a label id."""
+    def __init__(self):
+        self.fps = None
+        self.keys: dict[tuple[str, str, str], int] = {}
+        self.timestamps = array('d')
+        self.confidences = array('d')
+        self.ids = array('i')
+
+
+    def add(self, label: dict):
+        lbl = label['Label']
+        key = ('/'.join([x['Name'] for x in lbl['Categories']]),
+               lbl['Name'],
+               '/'.join([x['Name'] for x in lbl['Parents']]))
+        if key not in self.keys:
+            self.keys[key] = len(self.keys)
+        self.timestamps.append(label['Timestamp'])
+        self.confidences.append(lbl['Confidence'])
+        self.ids.append(self.keys[key])
+
+
+def read_labels(filename: str) -> Labels:
+    "Read a Rekognition labels file, without holding all of its JSON in memory if ijson is around"
+    labels = Labels()
+    if ijson:
+        with open(filename, "rb") as f:
+            labels.fps = next(ijson.items(f, 'VideoMetadata.FrameRate', use_float=True), None)
+        if labels.fps is None:
+            raise ValueError(f"{filename} doesn't have a VideoMetadata.FrameRate")
+        with open(filename, "rb") as f:
+            for label in ijson.items(f, 'Labels.item', use_float=True):
+                labels.add(label)
+        return labels
+
+    if orjson:
+        with open(filename, "rb") as f:
+            raw = orjson.loads(f.read())
+    else:
+        with open(filename) as f:
+            raw = json.load(f)
+    labels.fps = raw['VideoMetadata']['FrameRate']
+    for label in raw['Labels']:
+        labels.add(label)
+    return labels
+
+
+def sightings(labels: Labels, confidence: float, length: float, gap: float) -> list[tuple[int, float, float, float]]:
+    """Find the (label id, start ms, end ms, average confidence) sightings.
+       A label's detections are taken in the order they're in the file."""
+    if np is None:
+        return sightings_python(labels, confidence, length, gap)
+    if not len(labels.ids):
+        return []
+    ids = np.frombuffer(labels.ids, dtype=np.int32)
+    order = np.argsort(ids, kind='stable')
+    ids = ids[order]
+    ts = np.frombuffer(labels.timestamps)[order]
+    con = np.frombuffer(labels.confidences)[order]
+
+    # a sighting starts with a new label or after a gap
+    starts = np.flatnonzero(np.concatenate(([True], (ids[1:] != ids[:-1]) | (np.diff(ts) > gap))))
+    ends = np.concatenate((starts[1:], [len(ids)])) - 1
+    average = np.add.reduceat(con, starts) / (ends - starts + 1)
+    keep = (average >= confidence) & (ts[ends] - ts[starts] >= length)
+    return list(zip(ids[starts][keep].tolist(), ts[starts][keep].tolist(),
+                    ts[ends][keep].tolist(), average[keep].tolist()))
+
+
+def sightings_python(labels: Labels, confidence: float, length: float, gap: float) -> list[tuple[int, float, float, float]]:
+    "The same as sightings, one detection at a time"
+    runs: dict[int, list] = {}
+    found = []
+    def finish(i, run):
+        start, last, total, count = run
+        if total / count >= confidence and last - start >= length:
+            found.append((i, start, last, total / count))
+
+    for ts, con, i in zip(labels.timestamps, labels.confidences, labels.ids):
+        run = runs.get(i)
+        if run is not None and ts - run[1] <= gap:
+            run[1] = ts
+            run[2] += con
+            run[3] += 1
+            continue
+        if run is not None:
+            finish(i, run)
+        runs[i] = [ts, ts, con, 1]
+    for i, run in runs.items():
+        finish(i, run)
+    found.sort(key=lambda x: x[0])
+    return found
+
+
+def aggregate(filename: str, confidence: float, length: float, gap: float) -> dict:
+    "Aggregate a labels file into {framerate, labels: {category: {name: {parents: [[start, end, confidence]]}}}}"
+    labels = read_labels(filename)
+    names = {i: key for key, i in labels.keys.items()}
+    data = {'framerate': labels.fps,
+            'labels': {}}
+    for i, start, last, con in sightings(labels, confidence, length, gap):
+        cat, nam, key = names[i]
+        data['labels'].setdefault(cat, {}).setdefault(nam, {}).setdefault(key, []).append(
+            [ms2ts(start), ms2ts(last), con])
+    return data
+
+
+def aggregate_file(raw_data: str, aggregate_data: str, confidence: float, length: float, gap: float) -> int:
+    "Aggregate one file and write the results.  Returns the number of sightings"
+    data = aggregate(raw_data, confidence, length, gap)
+    with open(aggregate_data, "w") as f:
+        yaml.dump(data, f, Dumper=Dumper)
+    return sum([len(s) for names in data['labels'].values() for parents in names.values() for s in parents.values()])
+
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("raw_data")
-    parser.add_argument("aggregate_data")
+    parser.add_argument("raw_data", help="Rekognition labels JSON, or a directory of them")
+    parser.add_argument("aggregate_data", help="Aggregate YAML, or a directory for them")
     parser.add_argument("--confidence", type=float, default=50, help="filter by confidence (0-100)")
     parser.add_argument("--length", type=float, default=2, help="Minimum length of time to be considered a sighting")
     parser.add_argument("--gap", type=float, default=1, help="number of seconds to be considered a gap")
+    parser.add_argument("--pattern", default="*--rekognize-labels.json",
+                        help="Labels files to aggregate in a directory")
+    parser.add_argument("--workers", type=int, default=None, help="Number of files to aggregate at once")
     args = parser.parse_args()
 
     # convert length and gap to ms
-    args.gap *= 1000
-    args.length *= 1000
-
-    print("Loading labels")
-    with open(args.raw_data) as f:
-        #raw = yaml.safe_load(f)
-        raw = json.load(f)
-
-    print("Parsing data")
-    fps = raw['VideoMetadata']['FrameRate']
-    data = {'framerate': fps,
-            'labels': {}}
-    for label in raw['Labels']:
-        lbl = label['Label']
-        con = lbl['Confidence']   
-        cat = '/'.join([x['Name'] for x in lbl['Categories']])
-        nam = lbl['Name']
-        key = '/'.join([x['Name'] for x in lbl['Parents']])        
-        if cat not in data['labels']:
-            data['labels'][cat] = {}
-        if nam not in data['labels'][cat]:
-            data['labels'][cat][nam] = {}
-        if key not in data['labels'][cat][nam]:            
-            data['labels'][cat][nam][key] = []
-        data['labels'][cat][nam][key].append([label['Timestamp'], con])    
-
-    print("Filtering content")
-    for cat in data['labels']:
-        for nam in data['labels'][cat]:
-            for key in data['labels'][cat][nam]:
-                count = start = last = confidence = -1
-                ndata = []
-                for item in data['labels'][cat][nam][key]:            
-                    ts, con = item
-                    if start == -1:
-                        start = last = ts
-                        count = 1
-                        confidence = con
-                    else:
-                        if ts - last > args.gap:
-                            # too far apart...commit the last one
-                            rcon = confidence / count
-                            span = last - start
-                            if rcon >= args.confidence and span >= args.length:
-                                ndata.append([ms2ts(start), ms2ts(last), confidence / count])
-                            start = last = ts
-                            count = 1
-                            confidence = con
-                        else:
-                            # adjust values as necessary
-                            last = ts
-                            confidence += con
-                            count += 1
-                # we've reached the end.  Clean up anything that's left.
-                rcon = confidence / count
-                span = last - start
-                if rcon >= args.confidence and span >= args.length:
-                    ndata.append([ms2ts(start), ms2ts(last), confidence / count])
-
-                data['labels'][cat][nam][key] = ndata
-
-    # prune empty things
-    print("Pruning tree")
-    for cat in list(data['labels'].keys()):
-        for nam in list(data['labels'][cat].keys()):
-            for key in list(data['labels'][cat][nam].keys()):
-                if not len(data['labels'][cat][nam][key]):
-                    data['labels'][cat][nam].pop(key)
-            if not len(data['labels'][cat][nam]):
-                data['labels'][cat].pop(nam)
-        if not len(data['labels'][cat]):
-            data['labels'].pop(cat)
-
-
-
-    print("Writing aggregate data")
-    with open(args.aggregate_data, "w") as f:
-        yaml.safe_dump(data, f)
-
+    gap = args.gap * 1000
+    length = args.length * 1000
+
+    if not Path(args.raw_data).is_dir():
+        print(f"Aggregating {args.raw_data}")
+        count = aggregate_file(args.raw_data, args.aggregate_data, args.confidence, length, gap)
+        print(f"Wrote {count} sightings to {args.aggregate_data}")
+        return
+
+    files = sorted(Path(args.raw_data).glob(args.pattern))
+    outdir = Path(args.aggregate_data)
+    outdir.mkdir(parents=True, exist_ok=True)
+    print(f"Aggregating {len(files)} files")
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers or os.cpu_count(),
+                             mp_context=multiprocessing.get_context('spawn')) as ppe:
+        futures = {ppe.submit(aggregate_file, str(f), str(outdir / (f.stem + ".yaml")),
+                              args.confidence, length, gap): f for f in files}
+        for future, f in futures.items():
+            try:
+                print(f"{f.name}: {future.result()} sightings")
+            except Exception as e:
+                print(f"{f.name}: failed: {type(e).__name__}: {e}")
+                failed += 1
+    if failed:
+        raise SystemExit(f"{failed} of {len(files)} files failed")
 
 
 def ms2ts(ms):
@@ -103,6 +203,5 @@ def ms2ts(ms):
     return f"{hours:02d}:{mins:02d}:{ms:06.3f}"
 
 
-
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
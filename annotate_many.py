@@ -0,0 +1,167 @@
+#!/bin/env python3
+#
+# Render several variants of one video -- different zone layouts,
+# different annotation sets, different output sizes -- while only
+# decoding the source once.  Every batch of decoded frames goes to the
+# render workers once, each worker annotates it with every job's engine,
+# and the results are fanned out to one encoder per job.
+#
+# The jobs file is YAML:
+#
+#   jobs:
+#     - zoneconfig: clio_zones.yaml
+#       annotations: [local.yaml, rekognize.yaml]
+#       output: full.mp4
+#     - zoneconfig: reduced_zones.yaml
+#       annotations: [azure.yaml]
+#       output: small.mp4
+#       width: 960          # optional: scale the output to this width
+#
+
+import argparse
+from contextlib import ExitStack
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import yaml
+from yaml import CSafeLoader as Loader
+from pydantic import BaseModel
+from annotate_video import (Annotate, AnnotationConfig, RenderPipeline, ZoneConfig,
+                            annotate_raw, batched, report, text_sprites)
+from ffmpeg_pipe import FrameDecoder, FrameEncoder
+from metrics import Metrics
+import probe
+
+
+class Job(BaseModel):
+    """One variant of the video"""
+    zoneconfig: str
+    annotations: list[str]
+    output: str
+    width: int | None = None
+
+
+class JobList(BaseModel):
+    jobs: list[Job]
+
+
+class FanOut:
+    """Looks like one encoder to the render pipeline, but each 'frame' is
+       a tuple with one frame for each job's encoder"""
+    def __init__(self, encoders: list[FrameEncoder]):
+        self.encoders = encoders
+
+
+    def write(self, frames: tuple[bytes]):
+        for encoder, data in zip(self.encoders, frames):
+            encoder.write(data)
+
+
+# the annotation engines for a render worker, one per job
+worker_engines: list[Annotate] = []
+
+
+def init_worker(jobs: list[tuple[ZoneConfig, list[str]]], width: int, height: int):
+    "Set up the zone layouts, fonts and annotation stores for every job"
+    import annotation_store
+    worker_engines.clear()
+    for zoneconfig, stores in jobs:
+        anno = Annotate(zoneconfig, width, height)
+        for s in stores:
+            anno.add_store(annotation_store.AnnotationStore(s))
+        worker_engines.append(anno)
+
+
+def annotate_jobs(shards: list[AnnotationConfig], frames: tuple[tuple[int, bytes]]) -> tuple[list[tuple[bytes]], tuple[int, int, list[float]]]:
+    """Annotate a batch of raw RGB frames for every job.  Returns a tuple of
+       frames (one per job) for each frame, the sprite cache stats and the
+       seconds spent on each frame"""
+    hits, misses = text_sprites.hits, text_sprites.misses
+    for anno, shard in zip(worker_engines, shards):
+        anno.set_annotations(shard)
+    results = []
+    seconds = []
+    for framenum, data in frames:
+        t = time.time()
+        results.append(tuple([annotate_raw(anno, framenum, data) for anno in worker_engines]))
+        seconds.append(time.time() - t)
+    return results, (text_sprites.hits - hits, text_sprites.misses - misses, seconds)
+
+
+def main():
+    # the loaders are built on the models in annotate_video
+    import annotation_store
+    import annotation_loader
+
+    parser = argparse.ArgumentParser(description="Render several annotated variants of a video with one decode")
+    parser.add_argument("inputvideo", help="Input Video")
+    parser.add_argument("jobs", help="YAML file listing the zoneconfig, annotations and output of each job")
+    parser.add_argument("--batch-size", type=int, default=10, help="Frames sent to a worker at a time")
+    parser.add_argument("--workers", type=int, default=None, help="Number of render workers")
+    parser.add_argument("--frames-in-flight", type=int, default=None,
+                        help="Most frames being rendered at once (default: 2 batches per worker)")
+    parser.add_argument("--validate", choices=('full', 'sample', 'structure'), default='full',
+                        help="How much of the annotation files to validate.  Only skip it for trusted files")
+    parser.add_argument("--progress-interval", type=float, default=5,
+                        help="Seconds between progress lines")
+    parser.add_argument("--metrics", default=None, help="Write a JSON summary of the render metrics here")
+    args = parser.parse_args()
+
+    with open(args.jobs) as f:
+        jobs = JobList(**yaml.load(f, Loader=Loader)).jobs
+    info = probe.probe(args.inputvideo)
+    width, height = info.width, info.height
+
+    engines = []
+    zconfs = []
+    for job in jobs:
+        print(f"Loading {job.zoneconfig} for {job.output}")
+        zconf = ZoneConfig.load(job.zoneconfig)
+        anno = Annotate(zconf.model_copy(deep=True), width, height)
+        for afile in job.annotations:
+            print(f"Loading annotation file {afile}")
+            aconf = annotation_loader.load_annotations(afile, args.validate)
+            if isinstance(aconf, annotation_store.AnnotationStore):
+                anno.add_store(aconf)
+            else:
+                anno.add_annotations(aconf)
+        zconfs.append(zconf)
+        engines.append(anno)
+
+    workers = args.workers or os.cpu_count()
+    max_frames = args.frames_in_flight or 2 * workers * args.batch_size
+    batch_size = max(1, min(args.batch_size, max_frames))
+    print(f"Rendering {len(jobs)} jobs with {workers} workers, {max_frames} frames in flight")
+    metrics = Metrics(info.frames, workers, args.progress_interval)
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker,
+                             initargs=([(z, [x.filename for x in a.stores]) for z, a in zip(zconfs, engines)],
+                                       width, height)) as ppe:
+        with FrameDecoder(args.inputvideo, width, height, info.fps, queue_size=batch_size,
+                          metrics=metrics) as decoder, \
+             ExitStack() as stack:
+            encoders = [stack.enter_context(FrameEncoder(job.output, anno.width, anno.height, info.fps,
+                                                         audio_source=args.inputvideo,
+                                                         queue_size=batch_size, out_width=job.width,
+                                                         metrics=metrics))
+                        for job, anno in zip(jobs, engines)]
+            pipeline = RenderPipeline(ppe, FanOut(encoders), max_frames, task=annotate_jobs, metrics=metrics)
+            metrics.watch('decoded', decoder.queue.qsize)
+            metrics.watch('to_encode', lambda: max(e.queue.qsize() for e in encoders))
+            try:
+                for batch in batched(decoder, batch_size):
+                    first, last = batch[0][0], batch[-1][0]
+                    pipeline.submit([anno.shard(first, last) for anno in engines], batch)
+            finally:
+                pipeline.close()
+
+    report(metrics, args.metrics)
+
+
+if __name__ == "__main__":
+    # run from the importable module so the workers and the helper modules
+    # share its classes.
+    import annotate_many
+    annotate_many.main()
@@ -5,21 +5,36 @@
 #
 
 import argparse
+import os
+import multiprocessing
+import threading
 from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont, ImageColor
 import subprocess
 import tempfile
 import yaml
 from yaml import CSafeLoader as Loader, CSafeDumper as Dumper
-from pydantic import BaseModel as PydanticBaseModel, Field, ValidationError
+from pydantic import BaseModel as PydanticBaseModel, Field, PrivateAttr, ValidationError
 import pydantic
 from typing import Self, Any
 import shutil
 from concurrent.futures import ProcessPoolExecutor, Future
+from collections import OrderedDict
 import time
 import traceback
 import itertools
 from math import floor
+from fractions import Fraction
+from bisect import bisect_left, bisect_right
+from ffmpeg_pipe import FrameDecoder, FrameEncoder, audio_args
+from intervals import IntervalIndex
+from metrics import Metrics
+import probe
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 #
 # Zone Configuration
@@ -147,12 +162,26 @@ class ZoneConfig(BaseModel):
             # and load the font into the style itself
             s.font = ImageFont.truetype(s.font, size=floor(s.fontsize))
 
-        # make sure the height is even so ffmpeg is happy.
+        # make sure the dimensions are even so ffmpeg is happy.
+        if pwidth % 2:
+            pwidth += 1
         if pheight % 2:
             pheight += 1
         return (pwidth, pheight)
     
 
+    def scale(self, factor: float):
+        """Scale the zone and font sizes which are given in pixels, for 
+           rendering at a different content size.  Call this before 
+           set_content_size."""
+        for z in self.zones.values():
+            if z.size >= 1 and z.location != 'c':
+                z.size = max(1, round(z.size * factor))
+        for s in self.styles.values():
+            if s.fontsize >= 1:
+                s.fontsize = max(1, s.fontsize * factor)
+
+
     def get_zone(self, zone) -> Zone:
         """ Get the named zone"""
         return self.zones[zone]
@@ -166,27 +195,82 @@ class ZoneConfig(BaseModel):
 #
 # Annotation Configuration
 #
+class TextSprites:
+    """LRU cache of rendered text bitmaps (with alpha) so text that stays
+       the same from frame to frame is only rasterized once.  Each worker
+       process gets its own."""
+    def __init__(self, maxsize: int = 512):
+        self.maxsize = maxsize
+        self.sprites: OrderedDict[tuple, tuple[Image.Image, int, int]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, text: str, style: Style, anchor: str, fill: bool) -> tuple[Image.Image, int, int]:
+        "Get the sprite and its offset from the anchor point"
+        key = (text, style.font.path, style.font.size, tuple(style.foreground), 
+               tuple(style.background), anchor, fill)
+        if key in self.sprites:
+            self.hits += 1
+            self.sprites.move_to_end(key)
+            return self.sprites[key]
+        self.misses += 1
+        sprite = self.sprites[key] = self.render(text, style, anchor, fill)
+        if len(self.sprites) > self.maxsize:
+            self.sprites.popitem(last=False)
+        return sprite
+
+
+    @staticmethod
+    def render(text: str, style: Style, anchor: str, fill: bool) -> tuple[Image.Image, int, int]:
+        "Rasterize the text into an RGBA bitmap"
+        bbox = style.font.getbbox(text, anchor=anchor)
+        # the background box covers the bbox's right and bottom edges too,
+        # like canvas.rectangle does
+        size = (max(1, bbox[2] - bbox[0] + fill), max(1, bbox[3] - bbox[1] + fill))
+        mask = Image.new(mode='L', size=size)
+        ImageDraw.Draw(mask).text((-bbox[0], -bbox[1]), text, anchor=anchor, font=style.font, fill=255)
+        if fill:
+            # the background box is part of the sprite so it's opaque
+            sprite = Image.new(mode='RGBA', size=size, color=tuple(style.background))
+            sprite.paste(tuple(style.foreground), mask=mask)
+        else:
+            sprite = Image.new(mode='RGBA', size=size, color=tuple(style.foreground))
+            sprite.putalpha(mask)
+        return (sprite, bbox[0], bbox[1])
+
+
+text_sprites = TextSprites()
+
+
 class BaseAnnotation(BaseModel):
     """Base class for an annotation"""
     zone: str | Zone
     position: tuple[int, int] = (0, 0)
     style: str | Style | None = None # if none use zone default
 
-    def annotate(self, canvas: ImageDraw.ImageDraw):
+    def annotate(self, frame: Image.Image, canvas: ImageDraw.ImageDraw):
         raise NotImplementedError("Implement this!")
 
 
-    def drawtext(self, canvas: ImageDraw.ImageDraw, x, y, text, fill: bool = False, anchor='la'):
+    def fingerprint(self) -> tuple:
+        "Everything that affects how this annotation looks"
+        raise NotImplementedError("Implement this!")
+
+
+    def drawtext(self, frame: Image.Image, x, y, text, fill: bool = False, anchor='la'):
         """Draw text, with an optional background box"""
-        if fill:
-            bbox = self.style.font.getbbox(text=text, anchor='ld')
-            origin = self.zone.get_xy(*self.position)
-            canvas.rectangle([(origin[0] + bbox[0], origin[1] + bbox[1]),
-                              (origin[0] + bbox[2], origin[1] + bbox[3])],
-                              fill=self.style.background)
         try:
-            canvas.text(self.zone.get_xy(*self.position),
-                        text, anchor=anchor, font=self.style.font, fill=self.style.foreground)
+            sprite, dx, dy = text_sprites.get(text, self.style, anchor, fill)
+            origin = self.zone.get_xy(*self.position)
+            x, y = origin[0] + dx, origin[1] + dy
+            if frame.mode == 'RGBA':
+                # overlays need real alpha blending.  alpha_composite can't 
+                # take negative coordinates so clip the sprite instead.
+                sx, sy = max(0, -x), max(0, -y)
+                frame.alpha_composite(sprite, (x + sx, y + sy), (sx, sy))
+            else:
+                frame.paste(sprite, (x, y), sprite)
         except Exception as e:
             print(f"**** Cannot draw text on canvas: {e}.  Style: {self.style}.  Text is '{text}'")
 
@@ -205,9 +289,12 @@ class TextAnnotation(BaseAnnotation):
     text: str
     fill: bool = False
     
-    def annotate(self, canvas: ImageDraw.ImageDraw):
+    def annotate(self, frame: Image.Image, canvas: ImageDraw.ImageDraw):
         # draw the text annotation
-        self.drawtext(canvas, *self.position, self.text, fill=self.fill)
+        self.drawtext(frame, *self.position, self.text, fill=self.fill)
+
+    def fingerprint(self) -> tuple:
+        return ('text', self.text, tuple(self.position), self.fill, id(self.style))
               
 
 class BoxAnnotation(BaseAnnotation):
@@ -215,141 +302,722 @@ class BoxAnnotation(BaseAnnotation):
     text: str
     size: tuple[int, int]
 
-    def annotate(self, canvas: ImageDraw.ImageDraw):
+    def annotate(self, frame: Image.Image, canvas: ImageDraw.ImageDraw):
         self.drawborder(canvas, *self.position, *self.size)
         if self.text != '':
-            self.drawtext(canvas, *self.position, self.text, fill=True, anchor='ld')
+            self.drawtext(frame, *self.position, self.text, fill=True, anchor='ld')
+
+    def fingerprint(self) -> tuple:
+        return ('box', self.text, tuple(self.position), tuple(self.size), id(self.style))
+
+
+class SpanAnnotation(BaseModel):
+    """An annotation which is active for a range of frames"""
+    start_frame: int
+    end_frame: int  # inclusive
+
+
+class TextSpan(SpanAnnotation, TextAnnotation):
+    """text annotation over a range of frames"""
+
+
+class BoxSpan(SpanAnnotation, BoxAnnotation):
+    """box annotation over a range of frames"""
+
+
+class TrackAnnotation(BaseModel):
+    """A box which follows something around.  Only the keyframes where it
+       was seen, (frame, x, y, w, h), are stored.  Between two keyframes
+       which are at most gap frames apart (any distance if gap is None) the
+       box moves smoothly from one to the other.  Otherwise each keyframe
+       is held for hold more frames."""
+    id: int | str
+    zone: str | Zone = 'content'
+    style: str | Style | None = None
+    text: str = ''
+    keyframes: list[tuple[int, int, int, int, int]]
+    hold: int = 0
+    gap: int | None = None
+    # the interpolated boxes: (first frame, visible flags, boxes)
+    _boxes: tuple | None = PrivateAttr(default=None)
+
+    @property
+    def start_frame(self) -> int:
+        return self.keyframes[0][0]
+
+    @property
+    def end_frame(self) -> int:
+        return self.keyframes[-1][0] + self.hold
+
+
+    def window(self, first: int, last: int) -> Self:
+        "The part of the track which is needed to draw frames first to last"
+        frames = [k[0] for k in self.keyframes]
+        lo = max(0, bisect_right(frames, first) - 1)
+        hi = bisect_left(frames, last)
+        track = self.model_copy(update={'keyframes': self.keyframes[lo:hi + 1]})
+        track._boxes = None
+        return track
+
+
+    def interpolate(self) -> tuple[int, list[bool], list[list[int]]]:
+        "Work out the box on every frame of the track at once"
+        if self._boxes is None:
+            start, end = self.start_frame, self.end_frame
+            if np is not None:
+                kf = np.array(self.keyframes)
+                f, b = kf[:, 0], kf[:, 1:].astype(float)
+                frames = np.arange(start, end + 1)
+                i = np.searchsorted(f, frames, side='right') - 1
+                j = np.minimum(i + 1, len(f) - 1)
+                span = f[j] - f[i]
+                smooth = (j > i) & (span <= (self.gap if self.gap is not None else span))
+                t = np.where(smooth, (frames - f[i]) / np.maximum(span, 1), 0)
+                boxes = np.rint(b[i] + (b[j] - b[i]) * t[:, None]).astype(int)
+                visible = smooth | (frames - f[i] <= self.hold)
+                self._boxes = (start, visible.tolist(), boxes.tolist())
+            else:
+                frames = [k[0] for k in self.keyframes]
+                visible, boxes = [], []
+                for frame in range(start, end + 1):
+                    i = bisect_right(frames, frame) - 1
+                    a = self.keyframes[i]
+                    b = self.keyframes[min(i + 1, len(frames) - 1)]
+                    span = b[0] - a[0]
+                    smooth = span > 0 and (self.gap is None or span <= self.gap)
+                    t = (frame - a[0]) / span if smooth else 0
+                    visible.append(smooth or frame - a[0] <= self.hold)
+                    boxes.append([round(p + (q - p) * t) for p, q in zip(a[1:], b[1:])])
+                self._boxes = (start, visible, boxes)
+        return self._boxes
+
+
+    def at(self, frameid: int) -> BoxAnnotation | None:
+        "The box for a frame, if the track is showing on it"
+        start, visible, boxes = self.interpolate()
+        i = frameid - start
+        if not 0 <= i < len(visible) or not visible[i]:
+            return None
+        x, y, w, h = boxes[i]
+        return BoxAnnotation.model_construct(zone=self.zone, style=self.style, text=self.text,
+                                             position=(x, y), size=(w, h))
+
+
+    def boxes(self) -> list[tuple[int, int, BoxAnnotation]]:
+        "The box on every frame the track shows on, as (frame, frame, box)"
+        return [(f, f, box) for f in range(self.start_frame, self.end_frame + 1)
+                if (box := self.at(f)) is not None]
 
 
 class AnnotationConfig(BaseModel):
     """Annotation configuration"""
-    annotations: dict[int, list[BoxAnnotation | TextAnnotation]]
+    annotations: dict[int, list[BoxAnnotation | TextAnnotation]] = Field(default_factory=dict)
+    spans: list[BoxSpan | TextSpan] = Field(default_factory=list)
+    tracks: list[TrackAnnotation] = Field(default_factory=list)
 
 
 class Annotate:
-    def __init__(self, zoneconfig: ZoneConfig, content_width: int, content_height: int):
-        "Create an annotation engine"
+    def __init__(self, zoneconfig: ZoneConfig, content_width: int, content_height: int,
+                 scale: float = 1):
+        """Create an annotation engine.  If the content has been scaled, the 
+           pixel sizes in the zones and the annotations are scaled to match"""
         self.zc = zoneconfig
+        self.content_size = (content_width, content_height)
+        self.scale = scale
+        if scale != 1:
+            self.zc.scale(scale)
         # initialize the zones with the correct content size
         self.width, self.height = self.zc.set_content_size(content_width, content_height)
         self.cx, self.cy = self.zc.get_zone('content').get_xy(0, 0)
+        # everything outside of the content never changes, so draw it once.
+        self.background = self.render_background()
+        # the last rendering of each zone, keyed by zone name: (fingerprint, tile)
+        self.tiles: dict[str, tuple[tuple, Image.Image]] = {}
+        # where the tiles are drawn, so nothing spills out of a zone
+        self.scratch: Image.Image | None = None
         self.anno: dict[int, list[BaseAnnotation]] = {}
+        self.spans: list[tuple[int, int, BaseAnnotation]] = []
+        self.span_index = IntervalIndex()
+        self.tracks: list[tuple[int, int, TrackAnnotation]] = []
+        self.track_index = IntervalIndex()
+        # memory-mapped annotation stores which are queried frame by frame
+        self.stores: list = []
+
+
+    def resolve(self, a: BaseAnnotation):
+        """fixup the style and zone for an annotation.  This happens when
+           the annotation is drawn so the annotations held by the main 
+           process stay small and cheap to send to the workers"""
+        if not isinstance(a.zone, Zone):
+            a.zone = self.zc.get_zone(a.zone)
+            # this only happens once for each annotation
+            if self.scale != 1 and isinstance(a, TrackAnnotation):
+                a.keyframes = [(f, *[round(v * self.scale) for v in box]) for f, *box in a.keyframes]
+            elif self.scale != 1:
+                a.position = (round(a.position[0] * self.scale), round(a.position[1] * self.scale))
+                if isinstance(a, BoxAnnotation):
+                    a.size = (round(a.size[0] * self.scale), round(a.size[1] * self.scale))
+        if isinstance(a.style, str):
+            a.style = self.zc.get_style(a.style)
+        elif not isinstance(a.style, Style):
+            a.style = a.zone.style
 
 
     def add_annotations(self, annotations: AnnotationConfig):
         "add a list of annotations to the engine"
         for k, v in annotations.annotations.items():
-            # fixup the style and zone for each annotation
-            for a in v:
-                a: BaseAnnotation = a
-                if not isinstance(a.zone, Zone):
-                    a.zone = self.zc.get_zone(a.zone)
-                if isinstance(a.style, str):
-                    a.style = self.zc.get_style(a.style)
-                elif not isinstance(a.style, Style):
-                    a.style = a.zone.style
-
             if k not in self.anno:
                 self.anno[k] = []
             self.anno[k].extend(v)
 
+        for a in annotations.spans:
+            if a.end_frame < a.start_frame:
+                raise ValueError(f"Span ends before it starts: {a}")
+            self.spans.append((a.start_frame, a.end_frame, a))
+        self.span_index = IntervalIndex(self.spans)
+
+        for t in annotations.tracks:
+            if not t.keyframes or any(a[0] >= b[0] for a, b in zip(t.keyframes, t.keyframes[1:])):
+                raise ValueError(f"Track {t.id} needs keyframes in frame order")
+            self.tracks.append((t.start_frame, t.end_frame, t))
+        self.track_index = IntervalIndex(self.tracks)
+
+
+    def set_annotations(self, annotations: AnnotationConfig):
+        "replace the frame, span and track annotations in the engine"
+        self.anno = {}
+        self.spans = []
+        self.tracks = []
+        self.add_annotations(annotations)
+
+
+    def shard(self, first: int, last: int) -> AnnotationConfig:
+        "Get the frame, span and track annotations which are active between first and last"
+        return AnnotationConfig.model_construct(
+            annotations={k: self.anno[k] for k in range(first, last + 1) if k in self.anno},
+            spans=[a for _, _, a in self.span_index.overlapping(first, last)],
+            tracks=[t.window(first, last) for _, _, t in self.track_index.overlapping(first, last)])
+
+
+    def add_store(self, store):
+        """add an annotation store (see annotation_store.py) to the engine.
+           The store's tracks are handled like any other tracks."""
+        self.stores.append(store)
+        if store.tracks:
+            self.add_annotations(AnnotationConfig(tracks=store.tracks))
+
+
+    def last_frame(self) -> int:
+        "The last frame which has any annotations"
+        return max([max(self.anno, default=0), max([x[1] for x in self.spans], default=0),
+                    max([x[1] for x in self.tracks], default=0),
+                    *[s.last_frame() for s in self.stores]])
+
+
+    def change_points(self) -> list[int]:
+        "The frames where an annotation starts or stops"
+        points = set()
+        for k in self.anno:
+            points.update((k, k + 1))
+        for start, end, _ in self.spans:
+            points.update((start, end + 1))
+        for start, end, _ in self.tracks:
+            # a track can move on every frame
+            points.update(range(start, end + 2))
+        for store in self.stores:
+            points.update(store.change_points())
+        return sorted(points)
+
+
+    def ranges(self) -> list[tuple[int, int, BaseAnnotation]]:
+        """Every annotation with the (inclusive) range of frames it's shown
+           on.  Identical annotations on consecutive frames are merged."""
+        items = list(self.spans)
+        items.extend([(k, k, a) for k in sorted(self.anno) for a in self.anno[k]])
+        for store in self.stores:
+            items.extend(store.ranges())
+        for _, _, t in self.tracks:
+            self.resolve(t)
+            items.extend(t.boxes())
+        items.sort(key=lambda x: x[0])
+        runs: dict[tuple, list[list]] = {}
+        for start, end, a in items:
+            self.resolve(a)
+            group = runs.setdefault((id(a.zone), a.fingerprint()), [])
+            if group and start <= group[-1][1] + 1:
+                group[-1][1] = max(group[-1][1], end)
+            else:
+                group.append([start, end, a])
+        return [tuple(x) for group in runs.values() for x in group]
+
+
+    def get_annotations(self, frameid: int) -> list[BaseAnnotation]:
+        "Get all of the annotations which are active on a frame"
+        annotations = self.span_index.at(frameid) + self.anno.get(frameid, [])
+        for store in self.stores:
+            annotations.extend(store.annotations_at(frameid))
+        for t in self.track_index.at(frameid):
+            self.resolve(t)
+            if (box := t.at(frameid)) is not None:
+                annotations.append(box)
+        for a in annotations:
+            self.resolve(a)
+        return annotations
+
+
+    def render_background(self) -> Image.Image:
+        "Draw the static parts of the frame:  the zone fills, borders and titles"
+        background = Image.new(mode='RGB', size=(self.width, self.height))
+        canvas = ImageDraw.Draw(background)
+        for zn, z in self.zc.zones.items():
+            if zn == 'content':
+                # the frame itself covers this one.
+                continue
+            canvas.rectangle((z.x, z.y, z.x + z.w, z.y + z.h), 
+                             fill=z.style.background, outline=z.style.foreground)
+            if z.title:
+                # titles go in the upper right so they don't collide with
+                # the annotations which start at the upper left.
+                canvas.text((z.x + z.w - 2 * z.style.border, z.y), z.title, anchor='ra',
+                            font=z.style.font, fill=z.style.foreground)
+        return background
+
+
+    def overlay_fingerprint(self, frameid: int) -> tuple:
+        "Everything that affects how the overlay for a frame looks"
+        return tuple((id(a.zone), a.fingerprint()) for a in self.get_annotations(frameid))
+
+
+    def render_overlay(self, frameid: int) -> Image.Image:
+        """Render the zones and annotations for a frame onto a transparent
+           image which can be laid over the padded content"""
+        if not hasattr(self, 'overlay_background'):
+            self.overlay_background = self.background.convert('RGBA')
+            content = self.zc.get_zone('content')
+            self.overlay_background.paste((0, 0, 0, 0), (content.x, content.y, content.x + content.w, content.y + content.h))
+        overlay = self.overlay_background.copy()
+        canvas = ImageDraw.Draw(overlay)
+        for a in self.get_annotations(frameid):
+            a.annotate(overlay, canvas)
+        return overlay
+
+
+    def zone_tile(self, zn: str, z: Zone, annotations: list[BaseAnnotation]) -> Image.Image:
+        """The zone with its annotations drawn on it.  Anything that spills
+           out of the zone is clipped, so a reused tile looks exactly like
+           a freshly drawn one."""
+        fingerprint = tuple(a.fingerprint() for a in annotations)
+        if zn not in self.tiles or self.tiles[zn][0] != fingerprint:
+            if self.scratch is None:
+                self.scratch = self.background.copy()
+            box = (z.x, z.y, z.x + z.w, z.y + z.h)
+            # whatever was drawn here last time (by this zone or spilling
+            # over from another) is wiped first
+            self.scratch.paste(self.background.crop(box), box[:2])
+            canvas = ImageDraw.Draw(self.scratch)
+            for a in annotations:
+                a.annotate(self.scratch, canvas)
+            self.tiles[zn] = (fingerprint, self.scratch.crop(box))
+        return self.tiles[zn][1]
+
 
     def annotate_frame(self, frameid: int, frame: Image.Image) -> Image.Image:
-        # create a new image which is the full frame size
-        newframe = Image.new(mode=frame.mode, size=(self.width, self.height))
+        # start with a copy of the pre-drawn zones
+        newframe = self.background.copy()
         # copy the original image into the frame at the right place
         newframe.paste(frame, (self.cx, self.cy))
-        # get our canvas and draw the borders/titles for all our zones.
         canvas = ImageDraw.Draw(newframe)
-        for z in self.zc.zones.values():
-            canvas.rectangle((z.x, z.y, z.x + z.w, z.y + z.h))
-        
-        if frameid in self.anno:
-            for a in self.anno[frameid]:
-                a.annotate(canvas)
+
+        byzone: dict[int, list[BaseAnnotation]] = {}
+        for a in self.get_annotations(frameid):
+            byzone.setdefault(id(a.zone), []).append(a)
+
+        # the side zones usually show the same thing for long runs of
+        # frames, so if a zone's annotations haven't changed since the 
+        # last frame, reuse the tile that was rendered then.  
+        for zn, z in self.zc.zones.items():
+            if zn == 'content' or id(z) not in byzone:
+                continue
+            newframe.paste(self.zone_tile(zn, z, byzone.pop(id(z))), (z.x, z.y))
+
+        # whatever is left is on the content, which changes every frame.
+        for annotations in byzone.values():
+            for a in annotations:
+                a.annotate(newframe, canvas)
 
         return newframe
       
 
 def main():
+    # the loaders are built on the models in this module
+    import annotation_store
+    import annotation_loader
+
     parser = argparse.ArgumentParser()
     parser.add_argument("inputvideo", help="Input Video")
     parser.add_argument("outputvideo", help="Output Video")
     parser.add_argument("zoneconfig", help="Zone configurationf file")
     parser.add_argument("annotations", nargs='+', help="Annotations")
+    parser.add_argument("--batch-size", type=int, default=10, help="Frames sent to a worker at a time")
+    parser.add_argument("--workers", type=int, default=None, help="Number of render workers")
+    parser.add_argument("--frames-in-flight", type=int, default=None,
+                        help="Most frames being rendered at once (default: 2 batches per worker)")
+    parser.add_argument("--max-memory", type=float, default=None,
+                        help="Limit, in MB, for the frames held by the pipeline: the decoder and encoder "
+                             "queues and every copy of the frames being rendered")
+    parser.add_argument("--backend", choices=('frames', 'overlay', 'filter'), default='frames',
+                        help="Render every frame in python, only the overlays that change, "
+                             "or compile everything to an ffmpeg filter script")
+    parser.add_argument("--segments", type=int, default=1,
+                        help="Split the video into this many segments which are rendered in parallel")
+    parser.add_argument("--shots", default=None,
+                        help="scenedetect or Rekognition shot JSON used to pick the segment boundaries")
+    parser.add_argument("--cache", default=None,
+                        help="Directory of rendered segments to reuse when their inputs haven't changed")
+    parser.add_argument("--start", type=parse_time, default=None, 
+                        help="Preview: start at this time (seconds or [HH:]MM:SS)")
+    parser.add_argument("--end", type=parse_time, default=None,
+                        help="Preview: stop at this time (seconds or [HH:]MM:SS)")
+    parser.add_argument("--every", type=int, default=1, help="Preview: only render every Nth frame")
+    parser.add_argument("--scale", type=float, default=1, 
+                        help="Preview: scale the content (and the zones, fonts and annotations) by this much")
+    parser.add_argument("--validate", choices=('full', 'sample', 'structure'), default='full',
+                        help="How much of the annotation files to validate.  Only skip it for trusted files")
+    parser.add_argument("--progress-interval", type=float, default=5,
+                        help="Seconds between progress lines")
+    parser.add_argument("--metrics", default=None, help="Write a JSON summary of the render metrics here")
     args = parser.parse_args()
 
-    # get framerate
-    p = subprocess.run(['ffprobe', args.inputvideo], stdin=subprocess.DEVNULL,
-                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, 
-                        encoding='utf-8', check=True)
-    for l in p.stdout.splitlines():
-        if 'Stream' in l and 'Video' in l and 'fps' in l:
-            parts = [x.strip() for x in l.split(',') if 'fps' in x]
-            fps = parts[0].split()[0]
-            break
-    else:
-        raise ValueError("Cannot determine video framerate")
-
-    with tempfile.TemporaryDirectory() as tmpdir:
-        Path(tmpdir, "input").mkdir()
-        Path(tmpdir, "output").mkdir()
-        # some magick is needed to make sure we get absolutely every
-        # frame out of the video.
-        subprocess.run(['ffmpeg', 
-                        '-fflags', '+genpts', '-r', str(fps),
-                        '-i', args.inputvideo, 
-                        #'-vsync', '0',
-                        '-fps_mode', 'passthrough',
-                        f'{tmpdir}/input/%06d.jpg', f'{tmpdir}/audio.wav'],
-                       stdin=subprocess.DEVNULL, check=True)
-
-        # we need the first frame to get the content dimensions so we can
-        # compute the location of all of the zones.
-        print("Loading Zone Configuration...")
-        zconf = ZoneConfig.load(args.zoneconfig)
-        im = Image.open(f'{tmpdir}/input/000001.jpg')
-
-        anno = Annotate(zconf, im.width, im.height)
-
-        for afile in args.annotations:
-            print(f"Loading annotation file {afile}")
-            with open(afile) as f:
-                aconf = AnnotationConfig(**yaml.safe_load(f))
+    # we need the framerate and the content dimensions so we can compute
+    # the location of all of the zones before any frames show up.
+    info = probe.probe(args.inputvideo)
+    fps = info.fps
+    width, height = info.width, info.height
+    print(f"{args.inputvideo}: {width}x{height}, {info.frames} frames at {float(info.rate):0.3f} fps")
+
+    preview = args.start is not None or args.end is not None or args.every > 1 or args.scale != 1
+    if preview and (args.backend != 'frames' or args.segments > 1 or args.cache):
+        parser.error("The preview options only work with the frames backend and without segments")
+    if args.backend != 'frames' and (args.segments > 1 or args.cache or args.max_memory or args.frames_in_flight):
+        parser.error("--segments, --cache, --max-memory and --frames-in-flight only work with the frames backend")
+    if (args.segments > 1 or args.cache) and (args.max_memory or args.frames_in_flight):
+        parser.error("--max-memory and --frames-in-flight don't apply to segments, which each render in one process")
+    if args.scale != 1:
+        # ffmpeg wants even dimensions
+        width = max(2, round(width * args.scale / 2) * 2)
+        height = max(2, round(height * args.scale / 2) * 2)
+
+    print("Loading Zone Configuration...")
+    zconf = ZoneConfig.load(args.zoneconfig)
+    # the workers get their own pristine copy of the zones to lay out.
+    anno = Annotate(zconf.model_copy(deep=True), width, height, args.scale)
+    if args.max_memory:
+        # at the very least one frame everywhere one can be
+        smallest = pipeline_memory(width * height * 3, anno.width * anno.height * 3, 1, 1) / (1024 * 1024)
+        if args.max_memory < smallest:
+            parser.error(f"--max-memory must be at least {smallest:0.1f} MB for {anno.width}x{anno.height} frames")
+
+    for afile in args.annotations:
+        print(f"Loading annotation file {afile}")
+        aconf = annotation_loader.load_annotations(afile, args.validate)
+        if isinstance(aconf, annotation_store.AnnotationStore):
+            anno.add_store(aconf)
+        else:
             anno.add_annotations(aconf)        
 
-        # process the frames
-        ppe = ProcessPoolExecutor()
-        futures = {}
-        all_frames = [(x, Path(tmpdir, "output", x.name), int(x.stem)) for x in Path(tmpdir, "input").glob("*.jpg")]
-        
-        def batched(iterable, chunk_size):
-            iterator = iter(iterable)
-            while chunk := tuple(itertools.islice(iterator, chunk_size)):
-                yield chunk
-        
-        for batch in batched(all_frames, 500):
-            futures[batch[0][2]] = ppe.submit(annotate_files, anno, batch)
-        print("Waiting for everything to complete")
-        ppe.shutdown(True)
-
-        # put it back together.
-        subprocess.run(['ffmpeg', '-y', '-r', fps, '-i', f'{tmpdir}/output/%06d.jpg', '-i', f'{tmpdir}/audio.wav',
-                        '-r', fps, args.outputvideo], check=True, stdin=subprocess.DEVNULL)
+    match args.backend:
+        case 'frames' if args.segments > 1 or args.cache:
+            import segments
+            segments.render(args, zconf, anno, fps)
+        case 'frames':
+            render_frames(args, zconf, anno, fps)
+        case 'overlay':
+            metrics = Metrics(info.frames, 1, args.progress_interval)
+            render_overlays(args.inputvideo, args.outputvideo, anno, fps, metrics)
+            # ffmpeg renders every frame of the video
+            metrics.count('frames', info.frames)
+            report(metrics, args.metrics)
+        case 'filter':
+            import filter_script
+            metrics = Metrics(info.frames, 1, args.progress_interval)
+            filter_script.render(args.inputvideo, args.outputvideo, anno, fps, metrics)
+            metrics.count('frames', info.frames)
+            report(metrics, args.metrics)
+
+
+def pipeline_memory(in_bytes: int, out_bytes: int, batch_size: int, max_frames: int) -> int:
+    """The most bytes of frames that render_frames holds at once.  The
+       decoder queue, the batch waiting to be submitted and the encoder queue
+       each hold a batch.  A frame in flight is held twice on the way in
+       (by the executor and by the worker) and twice on the way out (by
+       the worker and by the pipeline, until it's written)."""
+    return batch_size * (2 * in_bytes + out_bytes) + max_frames * 2 * (in_bytes + out_bytes)
+
+
+def render_frames(args, zconf: ZoneConfig, anno: Annotate, fps: str):
+    """Stream the frames: ffmpeg decodes into a pipe, the workers annotate
+       batches of frames in memory and the results are fed, in order, to
+       the encoding ffmpeg."""
+    width, height = anno.content_size
+    workers = args.workers or os.cpu_count()
+    in_bytes = width * height * 3
+    out_bytes = anno.width * anno.height * 3
+    max_frames = args.frames_in_flight or 2 * workers * args.batch_size
+    batch_size = args.batch_size
+    if args.max_memory:
+        # the batches shrink until there's room for at least one of them in
+        # flight, and the rest of the budget goes to frames in flight.
+        budget = int(args.max_memory * 1024 * 1024)
+        batch_size = min(batch_size, budget // pipeline_memory(in_bytes, out_bytes, 1, 1))
+        max_frames = min(max_frames, (budget - pipeline_memory(in_bytes, out_bytes, batch_size, 0))
+                                     // pipeline_memory(in_bytes, out_bytes, 0, 1))
+    batch_size = max(1, min(batch_size, max_frames))
+    max_frames = max(max_frames, batch_size)
+    print(f"Rendering with {workers} workers, {max_frames} frames in flight, {batch_size} frames per batch")
+
+    # spawn the workers rather than forking them: a forked worker would
+    # inherit the encoder's stdin pipe and ffmpeg would never see EOF.
+    # Each worker builds its zone layout and fonts once, and each batch
+    # only carries the annotations for its own frames.
+    # previews can be a slice of the video, every Nth frame and/or scaled
+    rate = Fraction(fps)
+    first = 1 + round(args.start * rate) if args.start else 1
+    last = round(args.end * rate) if args.end else None
+    count = (last - first) // args.every + 1 if last else None
+    if count is not None and count < 1:
+        raise ValueError("Nothing to render between --start and --end")
+    preview = first > 1 or last or args.every > 1 or args.scale != 1
+    total = count if count is not None else len(range(first, probe.probe(args.inputvideo).frames + 1, args.every))
+    metrics = Metrics(total, workers, args.progress_interval)
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, 
+                             initargs=(zconf, width, height, [x.filename for x in anno.stores], args.scale)) as ppe:
+        with FrameDecoder(args.inputvideo, width, height, fps, queue_size=batch_size,
+                          start=first, count=count, step=args.every, resize=args.scale != 1,
+                          metrics=metrics) as decoder, \
+             FrameEncoder(args.outputvideo, anno.width, anno.height, str(rate / args.every),
+                          audio_source=args.inputvideo, queue_size=batch_size,
+                          audio_offset=float((first - 1) / rate) if preview else None,
+                          metrics=metrics) as encoder:
+            pipeline = RenderPipeline(ppe, encoder, max_frames, metrics=metrics)
+            metrics.watch('decoded', decoder.queue.qsize)
+            metrics.watch('to_encode', encoder.queue.qsize)
+            try:
+                for batch in batched(decoder, batch_size):
+                    pipeline.submit(anno.shard(batch[0][0], batch[-1][0]), batch)
+            finally:
+                pipeline.close()
+
+    report(metrics, args.metrics)
+
+
+def report(metrics: Metrics, filename: str | None = None):
+    "Print the final progress line and the sprite cache stats, and write the summary"
+    metrics.progress(force=True)
+    hits, misses = metrics.counters.get('sprite_hits', 0), metrics.counters.get('sprite_misses', 0)
+    if hits + misses:
+        print(f"Text sprite cache: {hits} hits, {misses} misses ({100 * hits / (hits + misses):0.1f}% hit rate)")
+    for name, h in metrics.histograms.items():
+        print(f"  {name:10s} mean {1000 * h.mean:8.2f}ms  p50 {1000 * h.percentile(50):8.2f}ms  "
+              f"p99 {1000 * h.percentile(99):8.2f}ms  max {1000 * h.max:8.2f}ms")
+    if filename:
+        metrics.write(filename)
+        print(f"Metrics are in {filename}")
+
+
+def render_overlays(inputvideo: str, outputvideo: str, anno: Annotate, fps: str,
+                    metrics: Metrics | None = None):
+    """Render a transparent overlay for the zones and annotations, but only
+       when it changes, and let ffmpeg lay it over the padded video.  The
+       content pixels never pass through python."""
+    rate = Fraction(fps)
+    metrics = metrics or Metrics()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # the overlay can only change where an annotation starts or stops
+        overlays = []
+        last = None
+        for frame in [1] + [x for x in anno.change_points() if x > 1]:
+            fingerprint = anno.overlay_fingerprint(frame)
+            if fingerprint == last:
+                continue
+            last = fingerprint
+            filename = Path(tmpdir, f"{frame:08d}.png")
+            with metrics.time('overlay'):
+                anno.render_overlay(frame).save(filename, compress_level=1)
+            overlays.append((frame, filename))
+        metrics.count('overlays', len(overlays))
+        print(f"Rendered {len(overlays)} overlays for {anno.last_frame()} frames")
+
+        # each overlay is shown until the next one starts and the last one
+        # is held (by tpad) until the video runs out.
+        concat = Path(tmpdir, "overlays.ffconcat")
+        with open(concat, "w") as f:
+            f.write("ffconcat version 1.0\n")
+            for (start, filename), (end, _) in zip(overlays, overlays[1:] + [(None, None)]):
+                f.write(f"file '{filename}'\n")
+                if end is not None:
+                    f.write(f"duration {float((end - start) / rate):0.6f}\n")
+
+        with metrics.time('ffmpeg'):
+            subprocess.run(['ffmpeg', '-y', 
+                            '-fflags', '+genpts', '-r', str(fps), '-i', inputvideo,
+                            '-f', 'concat', '-safe', '0', '-i', str(concat),
+                            '-filter_complex', 
+                            f"[0:v]format=rgb24,pad={anno.width}:{anno.height}:{anno.cx}:{anno.cy}[bg];"
+                            f"[1:v]tpad=stop=-1:stop_mode=clone[ov];"
+                            "[bg][ov]overlay=0:0:shortest=1[out]",
+                            '-map', '[out]', '-map', '0:a?', *audio_args(inputvideo, outputvideo),
+                            '-pix_fmt', 'yuv420p', '-r', str(fps), outputvideo],
+                           check=True, stdin=subprocess.DEVNULL)
+
+
+def parse_time(value: str) -> float:
+    "Convert seconds or [HH:]MM:SS[.sss] to seconds"
+    seconds = 0.0
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+class RenderPipeline:
+    """Keep a bounded number of frames in flight through the render workers
+       and feed the results to the encoder in frame order, as soon as the
+       next batch in line is ready.  Submitting blocks while the pipeline 
+       is full, which pushes back on the decoder."""
+    def __init__(self, executor: ProcessPoolExecutor, encoder: FrameEncoder, max_frames: int,
+                 task=None, metrics: Metrics | None = None):
+        self.executor = executor
+        self.encoder = encoder
+        # what the workers run on each batch: 
+        #   task(shard, batch) -> (frames, (hits, misses, seconds per frame))
+        self.task = task or annotate_frames
+        self.metrics = metrics or Metrics()
+        self.max_frames = max_frames
+        self.in_flight = 0
+        # finished batches waiting for their turn: sequence -> (frames, future)
+        self.ready: dict[int, tuple[int, Future]] = {}
+        self.next_submit = 0
+        self.next_write = 0
+        self.closed = False
+        self.error: BaseException | None = None
+        self.lock = threading.Condition()
+        self.metrics.watch('in_flight', lambda: self.in_flight)
+        self.writer = threading.Thread(target=self._writer, daemon=True)
+        self.writer.start()
+
+
+    def submit(self, shard: AnnotationConfig, batch: tuple[tuple[int, bytes]]):
+        "Send a batch of frames to the workers, waiting for room if needed"
+        with self.lock:
+            while self.in_flight + len(batch) > self.max_frames and self.error is None:
+                self.lock.wait()
+            if self.error:
+                raise self.error
+            self.in_flight += len(batch)
+            seq = self.next_submit
+            self.next_submit += 1
+        future = self.executor.submit(self.task, shard, batch)
+        future.add_done_callback(lambda f: self._done(seq, len(batch), f))
+
+
+    def _done(self, seq: int, count: int, future: Future):
+        with self.lock:
+            self.ready[seq] = (count, future)
+            self.lock.notify_all()
+
+
+    def _writer(self):
+        "Write the finished batches to the encoder in order"
+        while True:
+            with self.lock:
+                while self.next_write not in self.ready and \
+                        not (self.closed and self.next_write == self.next_submit):
+                    self.lock.wait()
+                if self.next_write not in self.ready:
+                    return
+                count, future = self.ready.pop(self.next_write)
+            try:
+                frames, (hits, misses, seconds) = future.result()
+                for frame in frames:
+                    self.encoder.write(frame)
+                self.metrics.count('frames', len(frames))
+                self.metrics.count('sprite_hits', hits)
+                self.metrics.count('sprite_misses', misses)
+                self.metrics.observe_many('annotate', seconds)
+                self.metrics.progress()
+            except BaseException as e:
+                with self.lock:
+                    self.error = e
+                    self.lock.notify_all()
+                return
+            with self.lock:
+                self.next_write += 1
+                self.in_flight -= count
+                self.lock.notify_all()
+
+
+    def close(self):
+        "Wait for everything that was submitted to be written"
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        self.writer.join()
+        if self.error:
+            raise self.error
+
+
+def batched(iterable, chunk_size):
+    iterator = iter(iterable)
+    while chunk := tuple(itertools.islice(iterator, chunk_size)):
+        yield chunk
 
     
-def annotate_files(anno: Annotate, frames: list[set]): #, infile, outfile, framenum):    
-    for infile, outfile, framenum in frames:
+# the annotation engine for a render worker, created by init_worker
+worker_anno: Annotate | None = None
+
+
+def init_worker(zoneconfig: ZoneConfig, width: int, height: int, stores: list[str], scale: float = 1):
+    "Set up the zone layout, fonts and annotation stores for a render worker"
+    global worker_anno
+    import annotation_store
+    worker_anno = Annotate(zoneconfig, width, height, scale)
+    for s in stores:
+        worker_anno.add_store(annotation_store.AnnotationStore(s))
+
+
+def annotate_frames(shard: AnnotationConfig, frames: tuple[tuple[int, bytes]]) -> tuple[list[bytes], tuple[int, int, list[float]]]:
+    """Annotate a batch of raw RGB frames with the annotations in the shard
+       and return the raw RGB results along with the text sprite cache 
+       (hits, misses) and the seconds spent on each frame"""
+    anno = worker_anno
+    anno.set_annotations(shard)
+    hits, misses = text_sprites.hits, text_sprites.misses
+    results = []
+    seconds = []
+    for framenum, data in frames:
         t = time.time()
-        try:      
-            im = Image.open(infile)
-            new_image = anno.annotate_frame(framenum, im)
-            new_image.save(outfile)
-            print(f"Modfied frame {infile} and wrote it to {outfile}:  {time.time() - t} seconds")
-        except Exception as e:
-            print(f"Caught exception for frame {framenum}: {e}")
-            traceback.print_exc() 
+        results.append(annotate_raw(anno, framenum, data))
+        seconds.append(time.time() - t)
+    return results, (text_sprites.hits - hits, text_sprites.misses - misses, seconds)
+
+
+def annotate_raw(anno: Annotate, framenum: int, data: bytes) -> bytes:
+    "Annotate one raw RGB frame"
+    im = Image.frombytes('RGB', anno.content_size, data)
+    try:      
+        new_image = anno.annotate_frame(framenum, im)
+    except Exception as e:
+        print(f"Caught exception for frame {framenum}: {e}")
+        traceback.print_exc() 
+        # the encoder needs every frame, so pass it through unannotated
+        new_image = Image.new(mode=im.mode, size=(anno.width, anno.height))
+        new_image.paste(im, (anno.cx, anno.cy))
+    return new_image.tobytes()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # run from the importable module so the helper modules which import
+    # annotate_video (like annotation_store) share its classes and caches.
+    import annotate_video
+    annotate_video.main()
\ No newline at end of file
@@ -0,0 +1,185 @@
+#!/bin/env python3
+#
+# Load annotation files as fast as possible.  The parser is picked by the
+# file format (C YAML, JSON or an annotation store), which is where nearly
+# all of the time goes.  Every annotation is validated by default;  for
+# trusted files only a sample (or just the structure) can be validated
+# and the rest built directly, but that saves little and lets a malformed
+# annotation through to the render.
+#
+# Run it directly to benchmark the load paths on real files.
+#
+
+import argparse
+import gc
+import json
+from pathlib import Path
+import tempfile
+import time
+import yaml
+from yaml import CSafeLoader as Loader
+from annotate_video import (AnnotationConfig, BaseAnnotation, BoxAnnotation, TextAnnotation,
+                            BoxSpan, TextSpan, TrackAnnotation)
+import annotation_store
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+VALIDATION = ('full', 'sample', 'structure')
+
+
+def parse_file(filename: str) -> dict:
+    "Parse a YAML or JSON annotation file with the fastest parser available"
+    if Path(filename).suffix.lower() == '.json':
+        if orjson:
+            with open(filename, "rb") as f:
+                return orjson.loads(f.read())
+        with open(filename) as f:
+            return json.load(f)
+    with open(filename) as f:
+        return yaml.load(f, Loader=Loader)
+
+
+def check_structure(data: dict):
+    "Make sure the data is shaped like an AnnotationConfig without looking too closely"
+    if not isinstance(data, dict) or not set(data.keys()) <= {'annotations', 'spans', 'tracks'}:
+        raise ValueError("Annotations must be a mapping with 'annotations', 'spans' and/or 'tracks'")
+    if not isinstance(data.get('annotations', {}), dict):
+        raise ValueError("'annotations' must map frame numbers to lists of annotations")
+    if not isinstance(data.get('spans', []), list):
+        raise ValueError("'spans' must be a list of annotations")
+    if not isinstance(data.get('tracks', []), list):
+        raise ValueError("'tracks' must be a list of tracks")
+    for k, v in data.get('annotations', {}).items():
+        if not isinstance(v, list):
+            raise ValueError(f"Annotations for frame {k} must be a list")
+        for a in v:
+            if not isinstance(a, dict) or 'zone' not in a or 'text' not in a:
+                raise ValueError(f"Bad annotation on frame {k}: {a}")
+    for a in data.get('spans', []):
+        if not isinstance(a, dict) or 'zone' not in a or 'text' not in a \
+                or 'start_frame' not in a or 'end_frame' not in a:
+            raise ValueError(f"Bad span: {a}")
+
+
+def check_sample(data: dict, sample_size: int):
+    "Run full validation over an evenly spaced sample of the annotations"
+    frames = [(k, a) for k, v in data.get('annotations', {}).items() for a in v]
+    spans = data.get('spans', [])
+    for items, build in ((frames, lambda x: AnnotationConfig(annotations={x[0]: [x[1]]})),
+                         (spans, lambda x: AnnotationConfig(spans=[x]))):
+        step = max(1, len(items) // sample_size)
+        for x in items[::step]:
+            build(x)
+
+
+# the defaults for the optional fields of each annotation type
+DEFAULTS = {cls: {k: f.default for k, f in cls.model_fields.items() if not f.is_required()}
+            for cls in (BoxAnnotation, TextAnnotation, BoxSpan, TextSpan)}
+
+
+def construct(cls: type[BaseAnnotation], a: dict) -> BaseAnnotation:
+    """Build a model directly from trusted data.  This is what pydantic's
+       model_construct does, minus the per-field bookkeeping that makes it
+       slower than just validating."""
+    obj = object.__new__(cls)
+    object.__setattr__(obj, '__dict__', {**DEFAULTS[cls], **a})
+    object.__setattr__(obj, '__pydantic_fields_set__', set(a))
+    object.__setattr__(obj, '__pydantic_extra__', None)
+    object.__setattr__(obj, '__pydantic_private__', None)
+    return obj
+
+
+def build_annotation(a: dict, span: bool = False) -> BaseAnnotation:
+    "Build an annotation from trusted data, skipping validation"
+    if span:
+        return construct(BoxSpan if 'size' in a else TextSpan, a)
+    return construct(BoxAnnotation if 'size' in a else TextAnnotation, a)
+
+
+def build_config(data: dict) -> AnnotationConfig:
+    "Build an AnnotationConfig from trusted data"
+    return AnnotationConfig.model_construct(
+        annotations={int(k): [build_annotation(a) for a in v] for k, v in data.get('annotations', {}).items()},
+        spans=[build_annotation(a, span=True) for a in data.get('spans', [])],
+        # there's one track for a lot of frames, so they're always validated
+        tracks=[TrackAnnotation(**t) for t in data.get('tracks', [])])
+
+
+def load_annotations(filename: str, validate: str = 'full', sample_size: int = 1000) -> AnnotationConfig | annotation_store.AnnotationStore:
+    """Load an annotation file.  Stores are memory-mapped, everything else
+       is validated according to validate (full, sample or structure)"""
+    if filename.endswith(annotation_store.EXTENSION):
+        return annotation_store.AnnotationStore(filename)
+    # millions of new objects and nothing to collect: the cyclic garbage
+    # collector would otherwise spend more time than the parsing.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        data = parse_file(filename)
+        if validate == 'full':
+            return AnnotationConfig(**data)
+        check_structure(data)
+        if validate == 'sample':
+            check_sample(data, sample_size)
+        return build_config(data)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def count_annotations(config: AnnotationConfig | annotation_store.AnnotationStore) -> int:
+    if isinstance(config, annotation_store.AnnotationStore):
+        return len(config)
+    return len(config.spans) + len(config.tracks) + sum([len(x) for x in config.annotations.values()])
+
+
+def benchmark(filename: str):
+    "Time every load path for a file and report seconds per million annotations"
+    def timeit(name, func):
+        t = time.time()
+        result = func()
+        elapsed = time.time() - t
+        count = count_annotations(result)
+        print(f"  {name:32s} {elapsed:8.3f}s  {count:10d} annotations  "
+              f"{elapsed * 1_000_000 / max(1, count):8.3f}s per million")
+        return result
+
+    print(f"Benchmarking {filename}")
+    if filename.endswith(annotation_store.EXTENSION):
+        timeit("store (mmap)", lambda: load_annotations(filename))
+        return
+
+    def pure_yaml():
+        with open(filename) as f:
+            return AnnotationConfig(**yaml.safe_load(f))
+
+    config = timeit("pure python yaml + full", pure_yaml)
+    for v in VALIDATION:
+        timeit(f"{Path(filename).suffix[1:]} + {v}", lambda: load_annotations(filename, v))
+
+    # the same data in the other formats.
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data = config.model_dump(mode='json')
+        jfile = str(Path(tmpdir, "annotations.json"))
+        with open(jfile, "w") as f:
+            json.dump(data, f)
+        for v in VALIDATION:
+            timeit(f"json{' (orjson)' if orjson else ''} + {v}", lambda: load_annotations(jfile, v))
+        sfile = str(Path(tmpdir, "annotations" + annotation_store.EXTENSION))
+        annotation_store.write_store(sfile, [config])
+        timeit("store (mmap)", lambda: load_annotations(sfile))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the annotation loaders")
+    parser.add_argument("annotations", nargs='+', help="Annotation files")
+    args = parser.parse_args()
+    for afile in args.annotations:
+        benchmark(afile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,554 @@
+#!/bin/env python3
+#
+# Turn the output of the analysis tools (mediapipe, tesseract, scenedetect,
+# whisper, Rekognition, Azure Video Indexer) into an annotation file.
+#
+# Every tool has an adapter which reads its file and yields annotation
+# records:  a dict with start_frame and end_frame (numbered from 1, like
+# ffmpeg, end inclusive) plus the annotation fields.  The records all go
+# to one SpanWriter which writes them as spans, extending a span when the
+# same annotation shows up again on the next frame, so something which
+# sits on screen for a minute is written once rather than 1800 times.
+#
+# Detections of something with an identity (like a Rekognition person)
+# are keyframe records instead:  a dict with track and frame.  They're
+# written as tracks, which are interpolated and held when rendered, so
+# the box follows the person between the sampled detections.
+#
+# Adding a tool means writing one adapter:
+#
+#   @source('mytool', '--mytool.json')
+#   def mytool(filename: str, fps: float) -> Iterator[dict]:
+#       ...
+#
+# The sources are independent, so each one is parsed and converted in
+# its own process and folded into spans there; only the spans come back
+# to be merged, in the order the sources were given.
+#
+# Run it directly with a basename to pick up every source it can find:
+#
+#   annotation_sources.py --basename media/kia out.yaml
+#   annotation_sources.py --source whisper-en=kia.yaml --source scenedetect=kia.json out.yaml
+#
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+from math import floor, ceil
+import multiprocessing
+import os
+from pathlib import Path
+from typing import Callable, Iterator
+import yaml
+from yaml import CSafeLoader as Loader, CSafeDumper as Dumper
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# the annotation fields, in the order they're written.
+FIELDS = ('zone', 'style', 'position', 'size', 'text')
+
+# seconds between two sightings of a tracked thing that are bridged by
+# moving its box, and seconds to keep showing it after a sighting.
+TRACK_GAP = 1.0
+TRACK_HOLD = 0.5
+
+
+class Adapter:
+    """A source of annotations.  The suffix is what the tool's file is named
+       after the basename, like '--mediapipe-faces.json'"""
+    def __init__(self, name: str, suffix: str | None, read: Callable[[str, float], Iterator[dict]]):
+        self.name = name
+        self.suffix = suffix
+        self.read = read
+
+
+SOURCES: dict[str, Adapter] = {}
+
+
+def source(name: str, suffix: str | None = None):
+    "Register an adapter function:  read(filename, fps) yields annotation records"
+    def register(func):
+        SOURCES[name] = Adapter(name, suffix, func)
+        return func
+    return register
+
+
+def load(filename: str):
+    "Parse a tool's output.  Most of them are JSON, which is much faster to parse as JSON."
+    if Path(filename).suffix.lower() == '.json':
+        if orjson:
+            with open(filename, "rb") as f:
+                return orjson.loads(f.read())
+        with open(filename) as f:
+            return json.load(f)
+    with open(filename) as f:
+        return yaml.load(f, Loader=Loader)
+
+
+def frame(seconds: float, fps: float, rounding=floor) -> int:
+    "The frame (numbered from 1) at a time"
+    return rounding(seconds * fps) + 1
+
+
+def timestamp2seconds(ts: str) -> float:
+    hours, mins, secs = [float(x) for x in ts.split(':')]
+    return hours * 3600 + mins * 60 + secs
+
+
+def record(start: int, end: int, zone: str, text: str, style: str | None = None,
+           position: tuple[int, int] | None = None, size: tuple[int, int] | None = None) -> dict:
+    r = {'start_frame': start, 'end_frame': end, 'zone': zone, 'text': text}
+    if style is not None:
+        r['style'] = style
+    if position is not None:
+        r['position'] = (int(position[0]), int(position[1]))
+    if size is not None:
+        r['size'] = (int(size[0]), int(size[1]))
+    return r
+
+
+def keyframe(track: int | str, n: int, zone: str, text: str, style: str | None,
+             position: tuple[int, int], size: tuple[int, int], hold: int = 0, gap: int | None = None) -> dict:
+    "A detection of something that's tracked, on frame n"
+    return {'track': track, 'frame': n, 'zone': zone, 'style': style, 'text': text,
+            'box': (int(position[0]), int(position[1]), int(size[0]), int(size[1])),
+            'hold': hold, 'gap': gap}
+
+
+def merge_spans(items):
+    """Take (start, end, confidence, text) spans which may overlap and
+       return non-overlapping (start, end, text) spans listing everything
+       that is active, highest confidence first"""
+    items = sorted(items, key=lambda x: x[0])
+    bounds = sorted({x[0] for x in items} | {x[1] + 1 for x in items})
+    active = []
+    here = 0
+    merged = []
+    for lo, hi in zip(bounds, bounds[1:]):
+        while here < len(items) and items[here][0] <= lo:
+            active.append(items[here])
+            here += 1
+        active = [x for x in active if x[1] >= lo]
+        if not active:
+            continue
+        text = ', '.join([x[3] for x in sorted(active, reverse=True, key=lambda n: n[2])])
+        if merged and merged[-1][1] == lo - 1 and merged[-1][2] == text:
+            # same thing as the previous span, so just extend it.
+            merged[-1][1] = hi - 1
+        else:
+            merged.append([lo, hi - 1, text])
+    return merged
+
+
+def by_confidence(things: list[tuple[float, str]]) -> str:
+    return ', '.join([x[1] for x in sorted(things, reverse=True, key=lambda n: n[0])])
+
+
+class SpanWriter:
+    """Collect annotation records and write them as spans.  A record that
+       starts where an identical one (same zone, style, box and text) ends
+       extends it instead of starting a new span.  Keyframe records are
+       gathered into tracks."""
+    def __init__(self):
+        # the newest span for each distinct annotation: key -> [start, end]
+        self.open: dict[tuple, list[int]] = {}
+        self.spans: list[tuple[int, int, tuple]] = []
+        # (track, zone, style, text) -> (hold, gap, keyframes)
+        self.tracks: dict[tuple, tuple[int, int | None, list]] = {}
+        self.records = 0
+
+
+    def add(self, r: dict):
+        self.records += 1
+        if 'track' in r:
+            self.add_keyframes((r['track'], r['zone'], r['style'], r['text']), r['hold'], r['gap'],
+                               [(r['frame'], *r['box'])])
+        else:
+            self.add_span(r['start_frame'], r['end_frame'], tuple([r.get(f) for f in FIELDS]))
+
+
+    def add_keyframes(self, key: tuple, hold: int, gap: int | None, keyframes: list[tuple]):
+        self.tracks.setdefault(key, (hold, gap, []))[2].extend(keyframes)
+
+
+    def add_span(self, start: int, end: int, key: tuple):
+        span = self.open.get(key)
+        if span is not None and span[0] <= start <= span[1] + 1:
+            span[1] = max(span[1], end)
+            return
+        if span is not None:
+            self.spans.append((*span, key))
+        self.open[key] = [start, end]
+
+
+    def extend(self, records: Iterator[dict]):
+        for r in records:
+            self.add(r)
+
+
+    def all_spans(self) -> list[tuple[int, int, tuple]]:
+        "(start, end, key) for every span, in frame order"
+        spans = self.spans + [(*span, key) for key, span in self.open.items()]
+        spans.sort(key=lambda x: (x[0], x[1], [str(v) for v in x[2]]))
+        return spans
+
+
+    def all_tracks(self) -> list[tuple[tuple, int, int | None, list]]:
+        "(key, hold, gap, keyframes) for every track, with one keyframe per frame, in frame order"
+        tracks = []
+        for key, (hold, gap, keyframes) in self.tracks.items():
+            seen = {}
+            for k in keyframes:
+                seen.setdefault(k[0], k)
+            tracks.append((key, hold, gap, [seen[f] for f in sorted(seen)]))
+        tracks.sort(key=lambda x: (x[3][0][0], [str(v) for v in x[0]]))
+        return tracks
+
+
+    def result(self) -> dict:
+        "The annotations, with the spans and tracks in frame order"
+        out = []
+        for start, end, key in self.all_spans():
+            s = {'start_frame': start, 'end_frame': end}
+            for f, v in zip(FIELDS, key):
+                if v is not None:
+                    s[f] = list(v) if isinstance(v, tuple) else v
+            out.append(s)
+        data = {'spans': out}
+        if self.tracks:
+            data['tracks'] = []
+            for (track, zone, style, text), hold, gap, keyframes in self.all_tracks():
+                t = {'id': track, 'zone': zone}
+                if style is not None:
+                    t['style'] = style
+                t.update({'text': text, 'hold': hold, 'gap': gap, 'keyframes': [list(k) for k in keyframes]})
+                data['tracks'].append(t)
+        return data
+
+
+    def write(self, filename: str):
+        "Write the annotations as JSON or YAML, by the file's suffix"
+        data = self.result()
+        if Path(filename).suffix.lower() == '.json' and orjson:
+            with open(filename, "wb") as f:
+                f.write(orjson.dumps(data))
+            return
+        with open(filename, "w") as f:
+            if Path(filename).suffix.lower() == '.json':
+                json.dump(data, f)
+            else:
+                yaml.dump(data, f, Dumper=Dumper, sort_keys=False, default_flow_style=None)
+
+
+def read_source(name: str, filename: str, fps: float) -> tuple[list, list, int]:
+    "Run one source through its adapter.  Returns its spans, its tracks and how many records it had."
+    writer = SpanWriter()
+    writer.extend(SOURCES[name].read(filename, fps))
+    return writer.all_spans(), writer.all_tracks(), writer.records
+
+
+def generate(outfile: str, inputs: list[tuple[str, str]], fps: float, workers: int | None = None):
+    """Run each (source name, filename) through its adapter and write the
+       spans.  The sources are read in parallel by up to workers processes."""
+    workers = min(workers or os.cpu_count(), len(inputs))
+    for name, filename in inputs:
+        print(f"Reading {name} from {filename}")
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as ppe:
+            futures = [ppe.submit(read_source, name, filename, fps) for name, filename in inputs]
+            results = [f.result() for f in futures]
+    else:
+        results = [read_source(name, filename, fps) for name, filename in inputs]
+
+    # merge in the order the sources were given, so the output doesn't
+    # depend on which worker finished first.
+    writer = SpanWriter()
+    for spans, tracks, records in results:
+        for start, end, key in spans:
+            writer.add_span(start, end, key)
+        for key, hold, gap, keyframes in tracks:
+            writer.add_keyframes(key, hold, gap, keyframes)
+        writer.records += records
+    spans = len(writer.spans) + len(writer.open)
+    print(f"Writing {spans} spans and {len(writer.tracks)} tracks from {writer.records} records to {outfile}")
+    writer.write(outfile)
+
+
+def find_sources(basename: str, names: list[str] | None = None) -> list[tuple[str, str]]:
+    "The (source name, filename) of every source that has a file next to the basename"
+    inputs = []
+    for name in names or SOURCES:
+        suffix = SOURCES[name].suffix
+        if suffix and Path(basename + suffix).exists():
+            inputs.append((name, basename + suffix))
+        elif names:
+            raise FileNotFoundError(f"There is no {basename}{suffix} for {name}")
+    return inputs
+
+
+#
+# mediapipe, tesseract, scenedetect and whisper
+#
+def categories(item: dict) -> list[tuple[str, float]]:
+    "mediapipe's (name, score) categories, from either the current or the older flat layout"
+    if 'categories' in item:
+        return item['categories']
+    return [(item.get('category') or item['category_name'], item['score'])]
+
+
+@source('mediapipe-objects', '--mediapipe-objects.json')
+def mediapipe_objects(filename: str, fps: float) -> Iterator[dict]:
+    for f in load(filename):
+        for o in f['objects']:
+            # in the file the frame index is 0-based but in ffmpeg the frames
+            # start at 1
+            name, score = categories(o)[0]
+            if score > 0.5:
+                n = f['frame_index'] + 1
+                yield record(n, n, 'content', f"{name} ({int(score * 100):d}%)",
+                             'object', (o['x'], o['y']), (o['w'], o['h']))
+
+
+@source('mediapipe-faces', '--mediapipe-faces.json')
+def mediapipe_faces(filename: str, fps: float) -> Iterator[dict]:
+    for f in load(filename):
+        n = f['frame_index'] + 1
+        for i, face in enumerate(f['faces']):
+            yield record(n, n, 'content', f"Face {i + 1} ({int(face['score'] * 100):d}%)",
+                         'face', (face['x'], face['y']), (face['w'], face['h']))
+
+
+@source('tesseract-ocr', '--tesseract-ocr.json')
+def tesseract_ocr(filename: str, fps: float) -> Iterator[dict]:
+    for f in load(filename)['frames']:
+        n = f['frame_num'] + 1
+        for b in f['blocks']:
+            yield record(n, n, 'content', b['text'], 'ocr', (b['left'], b['top']), (b['width'], b['height']))
+
+
+@source('mediapipe-imageclassification', '--mediapipe-imageclassification.json')
+def mediapipe_imageclassification(filename: str, fps: float) -> Iterator[dict]:
+    frames = {}
+    for f in load(filename):
+        frames.setdefault(f['frame_index'], []).extend([f"{c[0]} ({int(c[1] * 100):d} %)" for c in categories(f)])
+    for i, cats in frames.items():
+        yield record(i + 1, i + 1, 'imageclassification', ', '.join(cats))
+
+
+@source('scenedetect', '--scenedetect-adaptive.json')
+def scenedetect(filename: str, fps: float) -> Iterator[dict]:
+    for i, s in enumerate(load(filename)['scenes']):
+        yield record(s['start_frame'] + 1, s['end_frame'] + 1, 'scenedetect',
+                     f"Scene {i + 1}: {s['start_timecode']} - {s['end_timecode']}")
+
+
+@source('mediapipe-audioclassifier', '--mediapipe-audioclassifier.json')
+def mediapipe_audioclassifier(filename: str, fps: float) -> Iterator[dict]:
+    data = load(filename)
+    for i, event in enumerate(data):
+        # each event lasts until the next one, and the last one for a second
+        end = data[i + 1]['timestamp_ms'] if i < len(data) - 1 else event['timestamp_ms'] + 1000
+        cats = [f"{x[0]} ({x[1] * 100:0.2f}%)" for x in categories(event) if x[1] > 0]
+        yield record(frame(event['timestamp_ms'] / 1000, fps), frame(end / 1000, fps),
+                     'audioclassifier', ', '.join(cats))
+
+
+def whisper(lang: str):
+    @source(f"whisper-{lang}", f"--whisper-{lang}-structured.yaml")
+    def read(filename: str, fps: float) -> Iterator[dict]:
+        for s in load(filename)['segments']:
+            yield record(frame(s['start'], fps), frame(s['end'], fps, ceil), f"whisper-{lang}", s['text'])
+    return read
+
+
+for lang in ('en', 'es', 'fr', 'ja'):
+    whisper(lang)
+
+
+#
+# Rekognition:  every file carries its own frame rate and size
+#
+def rekognize_metadata(data: dict) -> tuple[float, int, int]:
+    meta = data['VideoMetadata']
+    if isinstance(meta, list):
+        meta = meta[0]
+    return meta['FrameRate'], meta['FrameWidth'], meta['FrameHeight']
+
+
+def rekognize_box(bbox: dict, width: int, height: int) -> tuple[tuple[int, int], tuple[int, int]]:
+    return ((floor(bbox['Left'] * width), floor(bbox['Top'] * height)),
+            (floor(bbox['Width'] * width), floor(bbox['Height'] * height)))
+
+
+@source('rekognize-text', '--rekognize-text.json')
+def rekognize_text(filename: str, fps: float) -> Iterator[dict]:
+    data = load(filename)
+    fps, width, height = rekognize_metadata(data)
+    for f in data['TextDetections']:
+        t = f['TextDetection']
+        if t['Type'] != 'LINE':
+            continue
+        n = frame(f['Timestamp'] / 1000, fps)
+        yield record(n, n, 'content', t['DetectedText'], 'ocr',
+                     *rekognize_box(t['Geometry']['BoundingBox'], width, height))
+
+
+@source('rekognize-labels', '--rekognize-labels.json')
+def rekognize_labels(filename: str, fps: float) -> Iterator[dict]:
+    data = load(filename)
+    fps, width, height = rekognize_metadata(data)
+    frames = {}
+    for f in data['Labels']:
+        lbl = f['Label']
+        frames.setdefault(frame(f['Timestamp'] / 1000, fps), []).append(
+            (lbl['Confidence'], f"{lbl['Name']} ({lbl['Categories'][0]['Name']}) {lbl['Confidence']:0.2f}%"))
+    for n, things in frames.items():
+        yield record(n, n, 'imageclassification', by_confidence(things))
+
+
+@source('rekognize-face', '--rekognize-face.json')
+def rekognize_face(filename: str, fps: float) -> Iterator[dict]:
+    data = load(filename)
+    fps, width, height = rekognize_metadata(data)
+    for f in data['Faces']:
+        face = f['Face']
+        # build a face description
+        desc = f"{face['Gender']['Value'][0]}({face['AgeRange']['Low']}-{face['AgeRange']['High']}) "
+        desc += f"{face['Emotions'][0]['Type']} ({face['Emotions'][0]['Confidence']:0.2f}%) "
+        desc += ','.join([feature for feature in ('Smile', 'Eyeglasses', 'Sunglasses', 'Beard',
+                                                  'Mustache', 'EyesOpen', 'MouthOpen')
+                          if face[feature]['Value']])
+        n = frame(f['Timestamp'] / 1000, fps)
+        yield record(n, n, 'content', desc, 'face', *rekognize_box(face['BoundingBox'], width, height))
+
+
+@source('rekognize-moderation', '--rekognize-moderation.json')
+def rekognize_moderation(filename: str, fps: float) -> Iterator[dict]:
+    data = load(filename)
+    fps, width, height = rekognize_metadata(data)
+    frames = {}
+    for f in data['ModerationLabels']:
+        lbl = f['ModerationLabel']
+        frames.setdefault(frame(f['Timestamp'] / 1000, fps), []).append(
+            (lbl['Confidence'], f"{lbl['Name']} ({lbl['Confidence']:0.2f}%)"))
+    for n, things in frames.items():
+        yield record(n, n, 'whisper-en', by_confidence(things))
+
+
+@source('rekognize-shots', '--rekognize-shots.json')
+def rekognize_shots(filename: str, fps: float) -> Iterator[dict]:
+    segments = []
+    for f in load(filename)['Segments']:
+        if f['Type'] == "SHOT":
+            confidence = f['ShotSegment']['Confidence']
+            text = f"Shot {f['ShotSegment']['Index']} ({confidence:0.2f}%) {f['StartTimecodeSMPTE']} - {f['EndTimecodeSMPTE']}"
+        elif f['Type'] == "TECHNICAL_CUE":
+            confidence = f['TechnicalCueSegment']['Confidence']
+            text = f"{f['TechnicalCueSegment']['Type']} ({confidence:0.2f}%) {f['StartTimecodeSMPTE']} - {f['EndTimecodeSMPTE']}"
+        else:
+            continue
+        segments.append((f['StartFrameNumber'] + 1, f['EndFrameNumber'] + 1, confidence, text))
+    # shots and technical cues can overlap, so they're merged into
+    # spans of identical text.
+    for start, end, text in merge_spans(segments):
+        yield record(start, end, 'audioclassifier', text)
+
+
+@source('rekognize-person', '--rekognize-person.json')
+def rekognize_person(filename: str, fps: float) -> Iterator[dict]:
+    data = load(filename)
+    fps, width, height = rekognize_metadata(data)
+    # people are tracked by index and sampled a few times a second, so the
+    # box glides between sightings up to TRACK_GAP apart and lingers for
+    # TRACK_HOLD after the last one.
+    hold, gap = round(TRACK_HOLD * fps), round(TRACK_GAP * fps)
+    for f in data['Persons']:
+        person = f['Person']
+        if 'BoundingBox' in person:
+            n = frame(f['Timestamp'] / 1000, fps)
+            yield keyframe(person['Index'], n, 'content', f"Person {person['Index']}", 'person',
+                           *rekognize_box(person['BoundingBox'], width, height), hold, gap)
+
+
+#
+# Azure Video Indexer:  one insights file with everything in it
+#
+# the insights which are listed in a zone, and which zone
+AZURE_GROUPS = {'topics': 'audioclassifier',
+                'labels': 'imageclassification',
+                'brands': 'whisper-es',
+                'namedLocations': 'whisper-fr',
+                'namedPeople': 'whisper-ja'}
+
+
+@source('azure')
+def azure(filename: str, fps: float) -> Iterator[dict]:
+    data = load(filename)['videos'][0]['insights']
+    groups = {z: [] for z in AZURE_GROUPS.values()}
+    for insight in ('transcript', 'ocr', 'topics', 'faces', 'labels',
+                    'scenes', 'shots', 'brands', 'namedPeople', 'namedLocations'):
+        for item_num, t in enumerate(data[insight], 1):
+            for i in t['instances']:
+                start = frame(timestamp2seconds(i['start']), fps)
+                end = frame(timestamp2seconds(i['end']), fps, ceil)
+                if insight == 'transcript':
+                    yield record(start, end, 'whisper-en', t['text'])
+                elif insight == 'ocr':
+                    yield record(start, end, 'content', t['text'], 'ocr',
+                                 (t['left'], t['top']), (t['width'], t['height']))
+                elif insight == 'scenes':
+                    yield record(start, end, 'scenedetect', f"Scene {item_num} {i['start']} - {i['end']}")
+                elif insight in ('topics', 'brands'):
+                    groups[AZURE_GROUPS[insight]].append((start, end, t['confidence'], t['name']))
+                elif insight == 'labels':
+                    groups[AZURE_GROUPS[insight]].append((start, end, i['confidence'], t['name']))
+                elif insight in ('namedLocations', 'namedPeople'):
+                    groups[AZURE_GROUPS[insight]].append((start, end, t['confidence'],
+                                                          f"{t['name']} ({i['instanceSource']})"))
+
+    for zone, items in groups.items():
+        items = [(start, end, c, f"{n} ({c * 100:0.2f}%)") for start, end, c, n in items]
+        for start, end, text in merge_spans(items):
+            yield record(start, end, zone, text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert analysis tool output to an annotation file")
+    parser.add_argument("outfile", nargs='?', help="Annotation file (YAML, or JSON by the suffix)")
+    parser.add_argument("--basename", default=None,
+                        help="Read every source with a file named BASENAME--<tool>...")
+    parser.add_argument("--sources", nargs='+', choices=sorted(SOURCES), default=None,
+                        help="Only read these sources from the basename")
+    parser.add_argument("--source", action='append', default=[], metavar="NAME=FILE",
+                        help="Read FILE with the NAME adapter")
+    parser.add_argument("--fps", type=float, default=30/1.001,
+                        help="Frame rate for sources which use timestamps")
+    parser.add_argument("--workers", type=int, default=None, help="Number of sources to read at once")
+    parser.add_argument("--list", action='store_true', help="List the sources")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, adapter in SOURCES.items():
+            print(f"{name:32s} {adapter.suffix or ''}")
+        return
+    if not args.outfile:
+        parser.error("An output file is needed")
+
+    inputs = find_sources(args.basename, args.sources) if args.basename else []
+    for s in args.source:
+        name, _, filename = s.partition('=')
+        if name not in SOURCES or not filename:
+            parser.error(f"Sources are NAME=FILE where NAME is one of {', '.join(sorted(SOURCES))}")
+        inputs.append((name, filename))
+    if not inputs:
+        parser.error("No sources were found")
+    generate(args.outfile, inputs, args.fps, args.workers)
+
+
+if __name__ == "__main__":
+    # run from the importable module so the workers find the same adapters
+    import annotation_sources
+    annotation_sources.main()
@@ -0,0 +1,262 @@
+#!/bin/env python3
+#
+# A compact, columnar, binary annotation store.  Annotations are stored
+# as int32 columns (start/end frame, zone, style, box, text) with all of
+# the strings interned in a single table, plus a bucketed frame index.
+# The loader memory-maps the file and only builds annotation objects for
+# the frames which are actually asked for.
+#
+# File layout (little endian, every section 8-byte aligned):
+#    header
+#    columns:  one int32 array per name in COLUMNS, n_rows long
+#    string offsets: int64[n_strings + 1]
+#    string data: utf-8
+#    bucket offsets: int32[n_buckets + 1]
+#    bucket rows: int32[n_bucket_rows]
+#    tracks: JSON list of the track annotations, which are kept whole
+#            since they're interpolated when they're drawn
+#
+
+import argparse
+from array import array
+import json
+import mmap
+import struct
+import sys
+import yaml
+from yaml import CSafeLoader as Loader
+from annotate_video import AnnotationConfig, BaseAnnotation, BoxAnnotation, TextAnnotation, TrackAnnotation
+
+MAGIC = b'AVANNO02'
+HEADER = struct.Struct('<8sqqqqqqq')  # magic, rows, strings, string bytes, buckets, bucket rows, bucket size, track bytes
+# stores written before tracks were added have no track section
+MAGIC_V1 = b'AVANNO01'
+HEADER_V1 = struct.Struct('<8sqqqqqq')
+COLUMNS = ('start', 'end', 'kind', 'zone', 'style', 'x', 'y', 'w', 'h', 'text', 'fill')
+KIND_TEXT = 0
+KIND_BOX = 1
+NO_STYLE = -1
+EXTENSION = '.annostore'
+
+
+def _padding(n: int) -> bytes:
+    return b'\0' * (-n % 8)
+
+
+def write_store(filename: str, configs: list[AnnotationConfig], bucket_size: int = 256):
+    "Write annotation configurations to a store file"
+    if sys.byteorder != 'little':
+        raise NotImplementedError("Annotation stores can only be written on little-endian machines")
+    strings: dict[str, int] = {}
+    def intern(s: str) -> int:
+        if s not in strings:
+            strings[s] = len(strings)
+        return strings[s]
+
+    cols = {c: array('i') for c in COLUMNS}
+    def add_row(start: int, end: int, a: BaseAnnotation):
+        if not isinstance(a.zone, str) or not (a.style is None or isinstance(a.style, str)):
+            raise ValueError(f"Only named zones and styles can be stored: {a}")
+        cols['start'].append(max(0, start))
+        cols['end'].append(max(0, end))
+        cols['kind'].append(KIND_BOX if isinstance(a, BoxAnnotation) else KIND_TEXT)
+        cols['zone'].append(intern(a.zone))
+        cols['style'].append(NO_STYLE if a.style is None else intern(a.style))
+        cols['x'].append(a.position[0])
+        cols['y'].append(a.position[1])
+        cols['w'].append(a.size[0] if isinstance(a, BoxAnnotation) else 0)
+        cols['h'].append(a.size[1] if isinstance(a, BoxAnnotation) else 0)
+        cols['text'].append(intern(a.text))
+        cols['fill'].append(int(getattr(a, 'fill', False)))
+
+    tracks = []
+    for config in configs:
+        for t in config.tracks:
+            if not isinstance(t.zone, str) or not (t.style is None or isinstance(t.style, str)):
+                raise ValueError(f"Only named zones and styles can be stored: {t}")
+            tracks.append(t.model_dump(mode='json'))
+        for a in config.spans:
+            add_row(a.start_frame, a.end_frame, a)
+        for frame in sorted(config.annotations):
+            for a in config.annotations[frame]:
+                add_row(frame, frame, a)
+
+    # the frame index:  which rows touch each bucket of frames
+    n_rows = len(cols['start'])
+    n_buckets = (max(cols['end']) // bucket_size + 1) if n_rows else 0
+    buckets = [array('i') for _ in range(n_buckets)]
+    for row in range(n_rows):
+        for b in range(cols['start'][row] // bucket_size, cols['end'][row] // bucket_size + 1):
+            buckets[b].append(row)
+    bucket_offsets = array('i', [0])
+    bucket_rows = array('i')
+    for b in buckets:
+        bucket_rows.extend(b)
+        bucket_offsets.append(len(bucket_rows))
+
+    blob = bytearray()
+    string_offsets = array('q', [0])
+    for s in strings:
+        blob.extend(s.encode('utf-8'))
+        string_offsets.append(len(blob))
+    track_data = json.dumps(tracks).encode('utf-8') if tracks else b''
+
+    with open(filename, "wb") as f:
+        f.write(HEADER.pack(MAGIC, n_rows, len(strings), len(blob), n_buckets,
+                            len(bucket_rows), bucket_size, len(track_data)))
+        for c in COLUMNS:
+            data = cols[c].tobytes()
+            f.write(data + _padding(len(data)))
+        f.write(string_offsets.tobytes())
+        f.write(blob + _padding(len(blob)))
+        data = bucket_offsets.tobytes()
+        f.write(data + _padding(len(data)))
+        data = bucket_rows.tobytes()
+        f.write(data + _padding(len(data)))
+        f.write(track_data)
+
+
+class AnnotationStore:
+    """Memory-mapped reader for an annotation store"""
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._open()
+
+
+    def _open(self):
+        if sys.byteorder != 'little':
+            raise NotImplementedError("Annotation stores can only be read on little-endian machines")
+        with open(self.filename, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = self.mm[:len(MAGIC)]
+        if magic == MAGIC:
+            (_, n_rows, n_strings, blob_size, n_buckets, n_bucket_rows, self.bucket_size,
+             track_size) = HEADER.unpack_from(self.mm, 0)
+            offset = HEADER.size
+        elif magic == MAGIC_V1:
+            _, n_rows, n_strings, blob_size, n_buckets, n_bucket_rows, self.bucket_size = HEADER_V1.unpack_from(self.mm, 0)
+            track_size = 0
+            offset = HEADER_V1.size
+        else:
+            raise ValueError(f"{self.filename} is not an annotation store")
+        self.rows = n_rows
+        view = memoryview(self.mm)
+
+        def section(length: int, fmt: str) -> memoryview:
+            nonlocal offset
+            size = length * struct.calcsize(fmt)
+            data = view[offset:offset + size].cast(fmt) if fmt != 'B' else view[offset:offset + size]
+            offset += size + (-size % 8)
+            return data
+
+        self.cols = {c: section(n_rows, 'i') for c in COLUMNS}
+        self.string_offsets = section(n_strings + 1, 'q')
+        self.blob = section(blob_size, 'B')
+        self.bucket_offsets = section(n_buckets + 1, 'i')
+        self.bucket_rows = section(n_bucket_rows, 'i')
+        self.n_buckets = n_buckets
+        # there are only ever a few tracks, so they're built up front.
+        self.tracks: list[TrackAnnotation] = []
+        if track_size:
+            self.tracks = [TrackAnnotation(**t) for t in json.loads(bytes(section(track_size, 'B')))]
+        # annotations that were active on the last frame asked for, so
+        # long spans aren't rebuilt on every frame.
+        self.live: dict[int, BaseAnnotation] = {}
+        self.strings: dict[int, str] = {}
+
+
+    def __getstate__(self):
+        # the mapping can't be pickled, but the file can be reopened.
+        return {'filename': self.filename}
+
+
+    def __setstate__(self, state):
+        self.filename = state['filename']
+        self._open()
+
+
+    def __len__(self):
+        return self.rows + len(self.tracks)
+
+
+    def last_frame(self) -> int:
+        "The last frame with any annotations"
+        return max(self.cols['end'], default=0)
+
+
+    def change_points(self) -> set[int]:
+        "The frames where an annotation starts or stops"
+        return set(self.cols['start']) | {x + 1 for x in self.cols['end']}
+
+
+    def ranges(self) -> list[tuple[int, int, BaseAnnotation]]:
+        "Every annotation with the range of frames it's active on"
+        return [(self.cols['start'][r], self.cols['end'][r], self.build(r)) for r in range(self.rows)]
+
+
+    def string(self, sid: int) -> str:
+        "Get an interned string"
+        if sid not in self.strings:
+            self.strings[sid] = str(self.blob[self.string_offsets[sid]:self.string_offsets[sid + 1]], 'utf-8')
+        return self.strings[sid]
+
+
+    def rows_at(self, frame: int) -> list[int]:
+        "Get the rows which are active on a frame"
+        b = frame // self.bucket_size
+        if frame < 0 or b >= self.n_buckets:
+            return []
+        start, end = self.cols['start'], self.cols['end']
+        return [r for r in self.bucket_rows[self.bucket_offsets[b]:self.bucket_offsets[b + 1]]
+                if start[r] <= frame <= end[r]]
+
+
+    def rows_between(self, first: int, last: int) -> list[int]:
+        "Get the rows which are active on any frame from first to last"
+        rows = set()
+        for b in range(max(0, first // self.bucket_size), min(self.n_buckets, last // self.bucket_size + 1)):
+            rows.update(self.bucket_rows[self.bucket_offsets[b]:self.bucket_offsets[b + 1]])
+        start, end = self.cols['start'], self.cols['end']
+        return sorted([r for r in rows if start[r] <= last and end[r] >= first])
+
+
+    def build(self, row: int) -> BaseAnnotation:
+        "Build the annotation for a row.  The data was validated when it was stored."
+        c = self.cols
+        style = c['style'][row]
+        fields = {'zone': self.string(c['zone'][row]),
+                  'style': None if style == NO_STYLE else self.string(style),
+                  'position': (c['x'][row], c['y'][row]),
+                  'text': self.string(c['text'][row])}
+        if c['kind'][row] == KIND_BOX:
+            return BoxAnnotation.model_construct(size=(c['w'][row], c['h'][row]), **fields)
+        return TextAnnotation.model_construct(fill=bool(c['fill'][row]), **fields)
+
+
+    def annotations_at(self, frame: int) -> list[BaseAnnotation]:
+        "Get the annotations which are active on a frame"
+        live = {}
+        for r in self.rows_at(frame):
+            live[r] = self.live[r] if r in self.live else self.build(r)
+        self.live = live
+        return list(live.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert annotation YAML files to an annotation store")
+    parser.add_argument("annotations", nargs='+', help="Annotation YAML files")
+    parser.add_argument("store", help=f"Output store (conventionally {EXTENSION})")
+    parser.add_argument("--bucket-size", type=int, default=256, help="Frames per index bucket")
+    args = parser.parse_args()
+
+    configs = []
+    for afile in args.annotations:
+        print(f"Loading annotation file {afile}")
+        with open(afile) as f:
+            configs.append(AnnotationConfig(**yaml.load(f, Loader=Loader)))
+    print(f"Writing {args.store}")
+    write_store(args.store, configs, args.bucket_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/bin/env python3
+#
+# Render a whole corpus of videos.  The manifest lists the jobs, as YAML:
+#
+#   jobs:
+#     - video: media/item1.mp4
+#       zoneconfig: clio_zones.yaml
+#       annotations: [item1-local.yaml, item1-rekognize.yaml]
+#       output: out/item1.mp4
+#       options: [--backend, overlay]     # optional, passed to annotate_video
+#
+# or as CSV with a video,zoneconfig,annotations,output header, where the
+# annotations are separated by semicolons.
+#
+# Each job is an annotate_video.py run with its own render workers, and
+# enough of them run at once to keep the cores busy.  The jobs are started
+# longest first (by the probed duration) so the short ones fill in the gaps
+# at the end instead of a long one starting last and running on alone.
+# Jobs whose output is newer than all of their inputs are skipped, failed
+# jobs are retried, and the status, timing and render metrics of every job
+# go in a JSON report.
+#
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+import threading
+import time
+import yaml
+from yaml import CSafeLoader as Loader
+from pydantic import BaseModel
+import probe
+
+ANNOTATE_VIDEO = str(Path(__file__).with_name('annotate_video.py'))
+
+
+class BatchJob(BaseModel):
+    """One video to render"""
+    video: str
+    zoneconfig: str
+    annotations: list[str]
+    output: str
+    options: list[str] = []
+
+
+class Manifest(BaseModel):
+    jobs: list[BatchJob]
+
+    @classmethod
+    def load(cls, filename: str) -> "Manifest":
+        if Path(filename).suffix.lower() == '.csv':
+            with open(filename, newline='') as f:
+                return cls(jobs=[BatchJob(video=r['video'], zoneconfig=r['zoneconfig'],
+                                          annotations=[a.strip() for a in r['annotations'].split(';') if a.strip()],
+                                          output=r['output'])
+                                 for r in csv.DictReader(f)])
+        with open(filename) as f:
+            return cls(**yaml.load(f, Loader=Loader))
+
+
+class JobStatus(BaseModel):
+    """What happened to a job, for the report"""
+    video: str
+    output: str
+    status: str = 'pending'  # done, skipped or failed
+    duration: float | None = None
+    frames: int | None = None
+    attempts: int = 0
+    seconds: float = 0
+    fps: float | None = None
+    error: str | None = None
+    log: str | None = None
+
+
+def up_to_date(job: BatchJob) -> bool:
+    "Is the output newer than everything that went into it?"
+    try:
+        built = os.stat(job.output).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    return all([os.stat(x).st_mtime_ns <= built for x in (job.video, job.zoneconfig, *job.annotations)])
+
+
+def run_job(job: BatchJob, status: JobStatus, workers: int, retries: int, logdir: Path, index: int):
+    "Render a job, retrying if it fails"
+    output = Path(job.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    # a failed render must never look like an up to date output
+    partial = output.with_name(output.stem + '.partial' + output.suffix)
+    metrics = logdir / f"{index:05d}-{output.stem}.metrics.json"
+    status.log = str(logdir / f"{index:05d}-{output.stem}.log")
+    cmd = [sys.executable, ANNOTATE_VIDEO, job.video, str(partial), job.zoneconfig, *job.annotations,
+           '--workers', str(workers), '--metrics', str(metrics), '--progress-interval', '30', *job.options]
+    start = time.time()
+    while status.attempts <= retries:
+        status.attempts += 1
+        with open(status.log, "a") as log:
+            log.write(f"### attempt {status.attempts}: {' '.join(cmd)}\n")
+            log.flush()
+            p = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+        if p.returncode == 0:
+            os.replace(partial, output)
+            status.status = 'done'
+            status.error = None
+            try:
+                status.fps = json.loads(metrics.read_text())['fps']
+            except (OSError, ValueError, KeyError):
+                pass
+            break
+        status.status = 'failed'
+        status.error = f"annotate_video exited with {p.returncode}"
+    if status.status != 'done':
+        partial.unlink(missing_ok=True)
+    status.seconds = time.time() - start
+
+
+def write_report(filename: str, statuses: list[JobStatus], started: float):
+    counts = {s: len([x for x in statuses if x.status == s]) for s in ('done', 'skipped', 'failed', 'pending')}
+    with open(filename, "w") as f:
+        json.dump({'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+                   'elapsed': time.time() - started,
+                   'summary': counts,
+                   'jobs': [s.model_dump() for s in statuses]}, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a manifest of videos, longest first, across the cores")
+    parser.add_argument("manifest", help="YAML or CSV list of video, zoneconfig, annotations and output")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Videos to render at once (default: cores / workers per job)")
+    parser.add_argument("--workers", type=int, default=2, help="Render workers for each video")
+    parser.add_argument("--retries", type=int, default=1, help="Times to retry a failed video")
+    parser.add_argument("--force", action='store_true', help="Render even if the output is up to date")
+    parser.add_argument("--report", default="batch_report.json", help="Status and timing report")
+    parser.add_argument("--logs", default=None, help="Directory for the job logs (default: next to the report)")
+    args = parser.parse_args()
+
+    started = time.time()
+    jobs = Manifest.load(args.manifest).jobs
+    concurrent = args.jobs or max(1, os.cpu_count() // args.workers)
+    logdir = Path(args.logs or Path(args.report).with_suffix('.logs'))
+    logdir.mkdir(parents=True, exist_ok=True)
+    statuses = [JobStatus(video=j.video, output=j.output) for j in jobs]
+
+    # probing a video reads all of it, so the probes run in parallel too.
+    def prepare(job: BatchJob, status: JobStatus):
+        try:
+            if not args.force and up_to_date(job):
+                status.status = 'skipped'
+                return
+            info = probe.probe(job.video)
+            status.duration = info.duration
+            status.frames = info.frames
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            status.status = 'failed'
+            status.error = f"{type(e).__name__}: {e}"
+
+    with ThreadPoolExecutor(max_workers=concurrent) as tpe:
+        list(tpe.map(prepare, jobs, statuses))
+
+    todo = sorted([i for i, s in enumerate(statuses) if s.status == 'pending'],
+                  key=lambda i: statuses[i].duration or 0, reverse=True)
+    skipped = len([s for s in statuses if s.status == 'skipped'])
+    print(f"{len(jobs)} jobs: {len(todo)} to render, {skipped} up to date, "
+          f"{len(jobs) - len(todo) - skipped} failed to probe.  "
+          f"Rendering {concurrent} at a time with {args.workers} workers each")
+
+    lock = threading.Lock()
+    finished = 0
+    def render(i: int):
+        nonlocal finished
+        try:
+            run_job(jobs[i], statuses[i], args.workers, args.retries, logdir, i)
+        except Exception as e:
+            statuses[i].status = 'failed'
+            statuses[i].error = f"{type(e).__name__}: {e}"
+        with lock:
+            finished += 1
+            s = statuses[i]
+            print(f"[{finished}/{len(todo)}] {s.status} {s.output} in {s.seconds:0.1f}s"
+                  + (f" ({s.attempts} attempts)" if s.attempts > 1 else "")
+                  + (f": {s.error}, see {s.log}" if s.error else ""), flush=True)
+            write_report(args.report, statuses, started)
+
+    # the executor takes the jobs in the order they're submitted
+    with ThreadPoolExecutor(max_workers=concurrent) as tpe:
+        list(tpe.map(render, todo))
+
+    write_report(args.report, statuses, started)
+    failed = [s for s in statuses if s.status == 'failed']
+    print(f"Done in {time.time() - started:0.1f}s.  Report is in {args.report}")
+    if failed:
+        raise SystemExit(f"{len(failed)} of {len(jobs)} jobs failed")
+
+
+if __name__ == "__main__":
+    main()
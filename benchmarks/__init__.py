@@ -0,0 +1,6 @@
+#
+# Throughput benchmarks built on synthetic inputs:  testsrc videos and
+# generated annotation files in the same schema as annotation.yaml.
+#
+#    python -m benchmarks.run --help
+#
@@ -0,0 +1,141 @@
+#!/bin/env python3
+#
+# Time every stage of the render on synthetic inputs -- probe, load,
+# decode, annotate_frame and encode -- for each combination of video
+# size and annotation density, and write the results as JSON so they can
+# be compared between releases.
+#
+
+import argparse
+from datetime import datetime, timezone
+import itertools
+import json
+from pathlib import Path
+import platform
+import subprocess
+import tempfile
+import time
+from PIL import Image
+from annotate_video import Annotate, ZoneConfig
+import annotation_loader
+from ffmpeg_pipe import FrameDecoder, FrameEncoder
+import probe
+from benchmarks import synthetic
+
+
+def stage(seconds: float, frames: int) -> dict:
+    return {'seconds': round(seconds, 4), 'fps': round(frames / seconds, 2) if seconds else None}
+
+
+def run_case(workdir: str, width: int, height: int, seconds: float, fps: int,
+             zones: int, boxes: int, churn: float, font: str | None) -> dict:
+    "Benchmark one combination of inputs"
+    base = Path(workdir)
+    video = str(base / f"video-{width}x{height}-{seconds}s-{fps}.mp4")
+    zonefile = str(base / f"zones-{zones}.yaml")
+    annofile = str(base / f"anno-{width}x{height}-{seconds}s-{fps}-{zones}z-{boxes}b-{churn}c.yaml")
+    synthetic.make_video(video, width, height, seconds, fps)
+    synthetic.make_zones(zonefile, zones, font)
+
+    # probe and load have nothing to do with the frames
+    t = time.time()
+    info = probe.run_ffprobe(video)
+    probe_time = time.time() - t
+    frames = info.frames
+    if not Path(annofile).exists():
+        synthetic.make_annotations(annofile, width, height, frames, zones, boxes, churn)
+    t = time.time()
+    config = annotation_loader.load_annotations(annofile)
+    load_time = time.time() - t
+
+    # decoding by itself
+    t = time.time()
+    with FrameDecoder(video, width, height, info.fps) as decoder:
+        for _ in decoder:
+            pass
+    decode_time = time.time() - t
+
+    # annotation, without the decode that feeds it
+    anno = Annotate(ZoneConfig.load(zonefile), width, height)
+    anno.add_annotations(config)
+    annotate_time = 0
+    last = None
+    with FrameDecoder(video, width, height, info.fps) as decoder:
+        for frameid, data in decoder:
+            t = time.time()
+            last = anno.annotate_frame(frameid, Image.frombytes('RGB', (width, height), data)).tobytes()
+            annotate_time += time.time() - t
+
+    # encoding the same number of (annotated) frames
+    t = time.time()
+    with FrameEncoder(str(base / "encoded.mp4"), anno.width, anno.height, info.fps,
+                      audio_source=video) as encoder:
+        for _ in range(frames):
+            encoder.write(last)
+    encode_time = time.time() - t
+
+    return {'video': {'width': width, 'height': height, 'seconds': seconds, 'fps': fps, 'frames': frames},
+            'annotations': {'zones': zones, 'boxes_per_frame': boxes, 'churn': churn,
+                            'count': annotation_loader.count_annotations(config)},
+            'stages': {'probe': stage(probe_time, frames),
+                       'load': stage(load_time, frames),
+                       'decode': stage(decode_time, frames),
+                       'annotate_frame': stage(annotate_time, frames),
+                       'encode': stage(encode_time, frames)}}
+
+
+def environment() -> dict:
+    "What the numbers were measured on"
+    def output(cmd):
+        try:
+            return subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                  stderr=subprocess.DEVNULL, encoding='utf-8').stdout.splitlines()[0]
+        except (OSError, IndexError):
+            return None
+    return {'date': datetime.now(timezone.utc).isoformat(),
+            'commit': output(['git', 'rev-parse', 'HEAD']),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'ffmpeg': output(['ffmpeg', '-version'])}
+
+
+def resolution(value: str) -> tuple[int, int]:
+    w, h = value.lower().split('x')
+    return int(w), int(h)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the render stages on synthetic inputs")
+    parser.add_argument("--resolutions", type=resolution, nargs='+',
+                        default=[(640, 360), (1280, 720), (1920, 1080)], help="WIDTHxHEIGHT of the videos")
+    parser.add_argument("--seconds", type=float, nargs='+', default=[10], help="Lengths of the videos")
+    parser.add_argument("--fps", type=int, default=30, help="Frame rate of the videos")
+    parser.add_argument("--zones", type=int, nargs='+', default=[4], help="Number of zones")
+    parser.add_argument("--boxes", type=int, nargs='+', default=[0, 10, 100], help="Boxes per frame")
+    parser.add_argument("--churn", type=float, nargs='+', default=[0.1],
+                        help="Chance that a zone's text changes between frames")
+    parser.add_argument("--font", default=None, help="Font for the zone configuration")
+    parser.add_argument("--workdir", default=None, help="Where to keep the generated inputs (default: a temp dir)")
+    parser.add_argument("--output", default="benchmark.json", help="Results file")
+    args = parser.parse_args()
+
+    results = {'environment': environment(), 'cases': []}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = args.workdir or tmpdir
+        Path(workdir).mkdir(parents=True, exist_ok=True)
+        for (width, height), seconds, zones, boxes, churn in itertools.product(
+                args.resolutions, args.seconds, args.zones, args.boxes, args.churn):
+            print(f"{width}x{height} {seconds}s, {zones} zones, {boxes} boxes per frame, {churn} churn")
+            case = run_case(workdir, width, height, seconds, args.fps, zones, boxes, churn, args.font)
+            for name, s in case['stages'].items():
+                print(f"  {name:16s} {s['seconds']:9.3f}s  {s['fps'] or 0:9.1f} fps")
+            results['cases'].append(case)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results are in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
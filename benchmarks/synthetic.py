@@ -0,0 +1,70 @@
+#
+# Generate synthetic benchmark inputs: test pattern videos, zone
+# configurations and annotation files with a given number of boxes per
+# frame and a given amount of text churn.
+#
+
+from pathlib import Path
+import random
+import subprocess
+import yaml
+from yaml import CSafeDumper as Dumper
+
+
+def make_video(filename: str, width: int, height: int, seconds: float, fps: int = 30):
+    "A testsrc2 video with a sine wave soundtrack"
+    if Path(filename).exists():
+        return
+    subprocess.run(['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+                    '-f', 'lavfi', '-i', f"testsrc2=size={width}x{height}:rate={fps}:duration={seconds}",
+                    '-f', 'lavfi', '-i', f"sine=frequency=440:duration={seconds}",
+                    '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+                    '-c:a', 'aac', '-shortest', filename],
+                   check=True, stdin=subprocess.DEVNULL)
+
+
+def zone_names(zones: int) -> list[str]:
+    return [f"zone{i}" for i in range(zones)]
+
+
+def make_zones(filename: str, zones: int, font: str | None = None):
+    "A zone configuration with zones alternating between the north and the south"
+    style = {'fontsize': 0.03}
+    if font:
+        style['font'] = font
+    data = {'zones': {name: {'title': f"Synthetic {name}",
+                             'location': 'north' if i % 2 else 'south',
+                             'size': 0.05}
+                      for i, name in enumerate(zone_names(zones))},
+            'styles': {'default': style}}
+    with open(filename, "w") as f:
+        yaml.dump(data, f, Dumper=Dumper)
+
+
+def make_annotations(filename: str, width: int, height: int, frames: int, zones: int,
+                     boxes: int, churn: float, seed: int = 0):
+    """Per-frame annotations: boxes on the content and a line of text in
+       every zone, where churn is the chance the text in a zone changes
+       from one frame to the next"""
+    rng = random.Random(seed)
+    names = zone_names(zones)
+    texts = {z: f"{z} item 0" for z in names}
+    changes = 0
+    annotations = {}
+    for frame in range(1, frames + 1):
+        items = []
+        for z in names:
+            if rng.random() < churn:
+                changes += 1
+                texts[z] = f"{z} item {changes}"
+            items.append({'zone': z, 'position': [0, 0], 'text': texts[z]})
+        for b in range(boxes):
+            w = rng.randint(10, max(11, width // 4))
+            h = rng.randint(10, max(11, height // 4))
+            items.append({'zone': 'content',
+                          'position': [rng.randint(0, width - w), rng.randint(0, height - h)],
+                          'size': [w, h],
+                          'text': f"object {b}"})
+        annotations[frame] = items
+    with open(filename, "w") as f:
+        yaml.dump({'annotations': annotations}, f, Dumper=Dumper)
@@ -0,0 +1,212 @@
+#!/bin/env python3
+#
+# Stream raw video frames in and out of ffmpeg through pipes so
+# frames never have to touch the disk.  The decoder and the encoder
+# each run a feeder thread with a bounded queue, so decoding, rendering
+# and encoding all happen at the same time with a fixed amount of memory.
+#
+
+from fractions import Fraction
+from pathlib import Path
+import subprocess
+import threading
+import time
+import queue
+from typing import Iterator
+import probe
+
+# audio codecs which each container can take without transcoding
+AUDIO_COPY = {
+    '.mp4': {'aac', 'mp3', 'ac3', 'eac3', 'alac', 'opus', 'flac'},
+    '.m4v': {'aac', 'mp3', 'ac3', 'eac3', 'alac'},
+    '.mov': {'aac', 'mp3', 'ac3', 'eac3', 'alac', 'pcm_s16le', 'pcm_s24le', 'pcm_s16be', 'pcm_s24be'},
+    '.mkv': None,  # anything goes
+    '.webm': {'opus', 'vorbis'},
+    '.ts': {'aac', 'mp3', 'mp2', 'ac3', 'eac3', 'opus'},
+    '.avi': {'mp3', 'ac3', 'pcm_s16le'},
+}
+
+
+def audio_args(source: str, output: str) -> list[str]:
+    """ffmpeg options to copy the audio streams from source straight into
+       output, if the output container can hold them.  Otherwise ffmpeg
+       transcodes them to the container's default."""
+    codecs = {a.codec for a in probe.probe(source).audio}
+    suffix = Path(output).suffix.lower()
+    if codecs and suffix in AUDIO_COPY and (AUDIO_COPY[suffix] is None or codecs <= AUDIO_COPY[suffix]):
+        return ['-c:a', 'copy']
+    return []
+
+
+class FrameDecoder:
+    """Decode a video into raw RGB24 frames on an ffmpeg pipe"""
+    def __init__(self, filename: str, width: int, height: int, fps: str, queue_size: int = 32,
+                 start: int = 1, count: int | None = None, step: int = 1, resize: bool = False,
+                 metrics=None):
+        """Decode count frames (or everything) starting at frame start, 
+           keeping every step-th frame.  With resize the video is scaled
+           to width x height, otherwise it has to be that size already.
+           The time spent waiting on each frame goes to metrics as 'decode'."""
+        self.width = width
+        self.height = height
+        self.frame_bytes = width * height * 3
+        self.start = start
+        self.step = step
+        self.metrics = metrics
+        self.error: Exception | None = None
+        # the same magick as the old jpeg extraction to make sure we get
+        # absolutely every frame out of the video.
+        cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'warning', '-fflags', '+genpts']
+        if start > 1:
+            # seek to half a frame before the one we want so rounding can't
+            # land us on the wrong side of it.  Forcing the input rate would
+            # throw away the timestamps that an accurate seek depends on.
+            cmd.extend(['-ss', f"{(start - 1.5) / Fraction(fps):0.6f}"])
+        else:
+            cmd.extend(['-r', str(fps)])
+        cmd.extend(['-i', filename, '-fps_mode', 'passthrough'])
+        filters = []
+        if step > 1:
+            filters.append(f"select=not(mod(n\\,{step}))")
+        if resize:
+            filters.append(f"scale={width}:{height}")
+        if filters:
+            cmd.extend(['-vf', ','.join(filters)])
+        if count is not None:
+            cmd.extend(['-frames:v', str(count)])
+        cmd.extend(['-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'])
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        self.queue = queue.Queue(queue_size)
+        self.thread = threading.Thread(target=self._reader, daemon=True)
+        self.thread.start()
+
+
+    def _reader(self):
+        "Pull frames off of ffmpeg's stdout until it runs dry"
+        try:
+            while True:
+                t = time.time()
+                data = self.proc.stdout.read(self.frame_bytes)
+                if len(data) < self.frame_bytes:
+                    break
+                if self.metrics:
+                    self.metrics.observe('decode', time.time() - t)
+                self.queue.put(data)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.queue.put(None)
+
+
+    def __iter__(self) -> Iterator[tuple[int, bytes]]:
+        "Yield (frameid, rgb data) tuples.  Frames are numbered from 1 like ffmpeg does"
+        frameid = self.start
+        while (data := self.queue.get()) is not None:
+            yield frameid, data
+            frameid += self.step
+        self.thread.join()
+        if self.error:
+            raise self.error
+        if self.proc.wait() != 0:
+            raise subprocess.CalledProcessError(self.proc.returncode, self.proc.args)
+
+
+    def close(self):
+        "Stop the decoder early"
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FrameEncoder:
+    """Encode raw RGB24 frames written to an ffmpeg pipe"""
+    def __init__(self, filename: str, width: int, height: int, fps: str,
+                 audio_source: str | None = None, queue_size: int = 32,
+                 out_width: int | None = None, audio_offset: float | None = None,
+                 metrics=None):
+        """Frames are width x height, and are scaled to out_width (if given)
+           when encoded.  With an audio_offset, the audio starts that many
+           seconds in and stops with the video.  The time ffmpeg takes to
+           accept each frame goes to metrics as 'encode'."""
+        self.frame_bytes = width * height * 3
+        self.metrics = metrics
+        self.error: Exception | None = None
+        cmd = ['ffmpeg', '-y',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f"{width}x{height}",
+               '-r', str(fps), '-i', '-']
+        if audio_source:
+            # pull the audio (if there is any) from the original file.
+            if audio_offset is not None:
+                cmd.extend(['-ss', f"{audio_offset:0.6f}"])
+            cmd.extend(['-i', audio_source, '-map', '0:v', '-map', '1:a?',
+                        *audio_args(audio_source, filename)])
+            if audio_offset is not None:
+                cmd.append('-shortest')
+        if out_width:
+            # keep the aspect ratio and an even height
+            cmd.extend(['-vf', f"scale={out_width}:-2"])
+        cmd.extend(['-pix_fmt', 'yuv420p', '-r', str(fps), filename])
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        self.queue = queue.Queue(queue_size)
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+
+    def _writer(self):
+        "Push frames into ffmpeg's stdin"
+        try:
+            while (data := self.queue.get()) is not None:
+                t = time.time()
+                self.proc.stdin.write(data)
+                if self.metrics:
+                    self.metrics.observe('encode', time.time() - t)
+        except Exception as e:
+            self.error = e
+            # keep draining so the producer never blocks on a dead encoder
+            while self.queue.get() is not None:
+                pass
+        finally:
+            self.proc.stdin.close()
+
+
+    def write(self, data: bytes):
+        "Queue a frame for encoding"
+        if len(data) != self.frame_bytes:
+            raise ValueError(f"Frame is {len(data)} bytes, expected {self.frame_bytes}")
+        self.queue.put(data)
+
+
+    def close(self):
+        "Finish encoding and wait for ffmpeg to exit"
+        self.queue.put(None)
+        self.thread.join()
+        if self.proc.wait() != 0:
+            raise subprocess.CalledProcessError(self.proc.returncode, self.proc.args)
+        if self.error:
+            raise self.error
+
+
+    def abort(self):
+        "Kill the encoder without finishing the file"
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
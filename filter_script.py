@@ -0,0 +1,168 @@
+#!/bin/env python3
+#
+# Compile the zones and annotations into an ffmpeg filter script: the
+# zones become a pad plus drawbox/drawtext filters, and every annotation
+# becomes a drawbox or drawtext filter which is only enabled for the
+# range of frames it's shown on.  A single ffmpeg then does all of the
+# rendering and python doesn't touch a single frame.
+#
+# Every annotation is a filter which is checked on every frame, so this
+# is meant for simple layouts with hundreds of annotations, not millions.
+#
+
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+from annotate_video import Annotate, BaseAnnotation, BoxAnnotation, Style, TextAnnotation
+from ffmpeg_pipe import audio_args
+from metrics import Metrics
+
+
+def find_font(name: str) -> str:
+    """Find the file for a font the same way PIL does, since ffmpeg needs
+       a real path"""
+    if os.path.exists(name):
+        return os.path.abspath(name)
+    dirs = []
+    if sys.platform == 'win32':
+        if windir := os.environ.get('WINDIR'):
+            dirs.append(os.path.join(windir, 'fonts'))
+    elif sys.platform == 'darwin':
+        dirs.extend(['/Library/Fonts', '/System/Library/Fonts', os.path.expanduser('~/Library/Fonts')])
+    else:
+        xdg_dirs = [os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share')]
+        xdg_dirs.extend((os.environ.get('XDG_DATA_DIRS') or '/usr/local/share:/usr/share').split(':'))
+        dirs.extend([os.path.join(x, 'fonts') for x in xdg_dirs])
+    for d in dirs:
+        for root, _, files in os.walk(d):
+            if name in files:
+                return os.path.join(root, name)
+    raise FileNotFoundError(f"Cannot find font file for {name}")
+
+
+def escape(value) -> str:
+    "Escape a value once for the filter's option parser and once for the filtergraph"
+    value = str(value)
+    for specials in ("\\':", "\\'[],;"):
+        value = ''.join(['\\' + c if c in specials else c for c in value])
+    return value
+
+
+def color(rgb: tuple[int, int, int]) -> str:
+    return '0x{:02x}{:02x}{:02x}'.format(*rgb)
+
+
+class FilterCompiler:
+    """Build the filter chain for an annotation engine"""
+    def __init__(self, anno: Annotate, textdir: str):
+        self.anno = anno
+        # drawtext reads the text from files so nothing in it needs escaping
+        self.textdir = textdir
+        self.textfiles: dict[str, str] = {}
+        self.fontfiles: dict[str, str] = {}
+        self.filters: list[str] = []
+
+
+    def add(self, name: str, enable: tuple[int, int] | None = None, **options):
+        if enable:
+            # ffmpeg counts frames from 0, we count them from 1.
+            options['enable'] = f"between(n,{enable[0] - 1},{enable[1] - 1})"
+        self.filters.append(name + '=' + ':'.join([f"{k}={escape(v)}" for k, v in options.items()]))
+
+
+    def textfile(self, text: str) -> str:
+        if text not in self.textfiles:
+            filename = str(Path(self.textdir, f"{len(self.textfiles)}.txt"))
+            with open(filename, "w", encoding='utf-8') as f:
+                f.write(text)
+            self.textfiles[text] = filename
+        return self.textfiles[text]
+
+
+    def fontfile(self, style: Style) -> str:
+        if style.font.path not in self.fontfiles:
+            self.fontfiles[style.font.path] = find_font(style.font.path)
+        return self.fontfiles[style.font.path]
+
+
+    def box(self, x: int, y: int, w: int, h: int, rgb, thickness, enable=None):
+        "A rectangle with the same corners that PIL would draw"
+        self.add('drawbox', enable, x=x, y=y, w=w + 1, h=h + 1, color=color(rgb), t=thickness)
+
+
+    def text(self, x: int, y: int, text: str, style: Style, fill: bool = False,
+             anchor: str = 'la', enable=None):
+        "Text placed like PIL's anchors: (l)eft or (r)ight, (a)scender or (d)escender"
+        ascent, descent = style.font.getmetrics()
+        if anchor[0] == 'r':
+            x -= int(style.font.getlength(text))
+        baseline = y + ascent if anchor[1] == 'a' else y - descent
+        # drawtext puts the tallest glyph of the text at y, so the baseline
+        # is max_glyph_a below it.  (y_align=baseline needs ffmpeg 6.1)
+        options = {'fontfile': self.fontfile(style), 'fontsize': style.font.size,
+                   'textfile': self.textfile(text), 'expansion': 'none',
+                   'fontcolor': color(style.foreground), 'x': x, 'y': f"{baseline}-max_glyph_a"}
+        if fill:
+            options.update({'box': 1, 'boxcolor': color(style.background), 'boxborderw': 0})
+        self.add('drawtext', enable, **options)
+
+
+    def zones(self):
+        "The padding and the static zone decorations"
+        anno = self.anno
+        self.add('pad', width=anno.width, height=anno.height, x=anno.cx, y=anno.cy, color='black')
+        for zn, z in anno.zc.zones.items():
+            if zn == 'content':
+                continue
+            self.box(z.x, z.y, z.w, z.h, z.style.background, 'fill')
+            self.box(z.x, z.y, z.w, z.h, z.style.foreground, 1)
+            if z.title:
+                self.text(z.x + z.w - 2 * z.style.border, z.y, z.title, z.style, anchor='ra')
+
+
+    def annotation(self, start: int, end: int, a: BaseAnnotation):
+        x, y = a.zone.get_xy(*a.position)
+        if isinstance(a, BoxAnnotation):
+            if a.style.border:
+                self.box(x, y, *a.size, a.style.foreground, a.style.border, (start, end))
+                self.box(x - 1, y - 1, a.size[0] + 2, a.size[1] + 2, a.style.background, 1, (start, end))
+            if a.text != '':
+                self.text(x, y, a.text, a.style, fill=True, anchor='ld', enable=(start, end))
+        elif isinstance(a, TextAnnotation):
+            self.text(x, y, a.text, a.style, fill=a.fill, enable=(start, end))
+        else:
+            raise NotImplementedError(f"Cannot compile {type(a).__name__} to a filter")
+
+
+    def compile(self) -> list[str]:
+        "Get the filter chain for the whole video"
+        self.filters = ['format=rgb24']
+        self.zones()
+        # the content is drawn last, like it is when rendering frames
+        content = self.anno.zc.get_zone('content')
+        for start, end, a in sorted(self.anno.ranges(), key=lambda x: x[2].zone is content):
+            self.annotation(start, end, a)
+        return self.filters
+
+
+def render(inputvideo: str, outputvideo: str, anno: Annotate, fps: str, metrics: Metrics | None = None):
+    "Annotate a video with a single ffmpeg run"
+    metrics = metrics or Metrics()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with metrics.time('compile'):
+            filters = FilterCompiler(anno, tmpdir).compile()
+        metrics.count('filters', len(filters))
+        script = Path(tmpdir, "annotate.filters")
+        with open(script, "w") as f:
+            f.write("[0:v]" + ",\n".join(filters) + "[out]\n")
+        print(f"Compiled {len(filters)} filters")
+        with metrics.time('ffmpeg'):
+            subprocess.run(['ffmpeg', '-y',
+                            '-fflags', '+genpts', '-r', str(fps), '-i', inputvideo,
+                            # deprecated in ffmpeg 7, but -/filter_complex is new in 7
+                            '-filter_complex_script', str(script),
+                            '-map', '[out]', '-map', '0:a?', *audio_args(inputvideo, outputvideo),
+                            '-pix_fmt', 'yuv420p', '-r', str(fps), outputvideo],
+                           check=True, stdin=subprocess.DEVNULL)
@@ -0,0 +1,105 @@
+#
+# A static interval index (a centered interval tree) for finding which
+# spans are active at a given frame.
+#
+
+from typing import Any, Iterable
+
+
+class _Node:
+    __slots__ = ('center', 'by_start', 'by_end', 'left', 'right')
+
+    def __init__(self, center: int, by_start: list, by_end: list, left, right):
+        self.center = center
+        self.by_start = by_start
+        self.by_end = by_end
+        self.left = left
+        self.right = right
+
+
+class IntervalIndex:
+    """Index of closed [start, end] intervals which can answer the question
+       'what is active at point N' in O(log n + k)"""
+    def __init__(self, intervals: Iterable[tuple[int, int, Any]] = ()):
+        # each item gets a sequence number so results come back in the
+        # same order that they were added.
+        items = [(s, e, i, v) for i, (s, e, v) in enumerate(intervals)]
+        self.count = len(items)
+        self.root = self._build(items)
+
+
+    def __len__(self):
+        return self.count
+
+
+    @classmethod
+    def _build(cls, items: list) -> _Node | None:
+        if not items:
+            return None
+        # the median of the endpoints keeps the tree balanced.
+        points = sorted([x[0] for x in items] + [x[1] for x in items])
+        center = points[len(points) // 2]
+        left, right, here = [], [], []
+        for x in items:
+            if x[1] < center:
+                left.append(x)
+            elif x[0] > center:
+                right.append(x)
+            else:
+                here.append(x)
+        return _Node(center,
+                     sorted(here, key=lambda x: x[0]),
+                     sorted(here, key=lambda x: x[1], reverse=True),
+                     cls._build(left), cls._build(right))
+
+
+    def at(self, point: int) -> list[Any]:
+        "Get the values of all of the intervals which contain point"
+        found = []
+        node = self.root
+        while node is not None:
+            if point < node.center:
+                for x in node.by_start:
+                    if x[0] > point:
+                        break
+                    found.append(x)
+                node = node.left
+            elif point > node.center:
+                for x in node.by_end:
+                    if x[1] < point:
+                        break
+                    found.append(x)
+                node = node.right
+            else:
+                found.extend(node.by_start)
+                break
+        found.sort(key=lambda x: x[2])
+        return [x[3] for x in found]
+
+
+    def overlapping(self, start: int, end: int) -> list[tuple[int, int, Any]]:
+        "Get (start, end, value) for all of the intervals which overlap [start, end]"
+        found = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            if end < node.center:
+                for x in node.by_start:
+                    if x[0] > end:
+                        break
+                    found.append(x)
+                stack.append(node.left)
+            elif start > node.center:
+                for x in node.by_end:
+                    if x[1] < start:
+                        break
+                    found.append(x)
+                stack.append(node.right)
+            else:
+                found.extend(node.by_start)
+                stack.append(node.left)
+                stack.append(node.right)
+        found.sort(key=lambda x: x[2])
+        return [(x[0], x[1], x[3]) for x in found]
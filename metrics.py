@@ -0,0 +1,187 @@
+#
+# Throughput metrics for the render pipeline:  counters, latency
+# histograms for each stage, samples of the queue depths and how busy
+# the workers are.  Instead of a line for every frame, a single progress
+# line (with the frame rate and an ETA) is printed every so often, and a
+# JSON summary can be written at the end.
+#
+
+from contextlib import contextmanager
+import json
+import math
+import threading
+import time
+
+
+class Histogram:
+    """Latencies in logarithmic buckets, 4 per doubling, from 10us up"""
+    BASE = 1e-5
+    PER_DOUBLING = 4
+
+    def __init__(self):
+        self.buckets: dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+
+    def add(self, seconds: float):
+        b = max(0, math.ceil(math.log2(max(seconds, self.BASE) / self.BASE) * self.PER_DOUBLING))
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+
+    def percentile(self, p: float) -> float:
+        "The upper edge of the bucket holding the p-th percentile"
+        if not self.count:
+            return 0.0
+        target = p / 100 * self.count
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= target:
+                return min(self.max, self.BASE * 2 ** (b / self.PER_DOUBLING))
+        return self.max
+
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+    def summary(self) -> dict:
+        return {'count': self.count, 'total': self.total, 'mean': self.mean,
+                'min': self.min if self.count else 0.0, 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99)}
+
+
+class Gauge:
+    """Samples of something which goes up and down, like a queue depth"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.last = 0
+
+
+    def set(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.last = value
+
+
+    def summary(self) -> dict:
+        return {'samples': self.count, 'mean': self.total / self.count if self.count else 0,
+                'max': self.max, 'last': self.last}
+
+
+class Metrics:
+    """Metrics for one render.  Safe to update from any thread."""
+    def __init__(self, total_frames: int | None = None, workers: int = 1, interval: float = 5.0):
+        self.total_frames = total_frames
+        self.workers = workers
+        self.interval = interval
+        self.start = time.time()
+        self.last_report = self.start
+        self.counters: dict[str, int] = {}
+        self.histograms: dict[str, Histogram] = {}
+        self.gauges: dict[str, Gauge] = {}
+        # things to sample for gauges whenever progress is reported
+        self.probes: dict[str, callable] = {}
+        self.lock = threading.Lock()
+
+
+    def count(self, name: str, n: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+
+    def observe(self, name: str, seconds: float):
+        "Record a latency"
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].add(seconds)
+
+
+    def observe_many(self, name: str, values: list[float]):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            for v in values:
+                self.histograms[name].add(v)
+
+
+    @contextmanager
+    def time(self, name: str):
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - t)
+
+
+    def gauge(self, name: str, value: float):
+        with self.lock:
+            if name not in self.gauges:
+                self.gauges[name] = Gauge()
+            self.gauges[name].set(value)
+
+
+    def watch(self, name: str, func):
+        "Sample func() into a gauge every time progress is reported"
+        self.probes[name] = func
+
+
+    def utilization(self, elapsed: float) -> float:
+        "How much of the time the workers spent rendering"
+        busy = self.histograms['annotate'].total if 'annotate' in self.histograms else 0
+        return busy / (elapsed * self.workers) if elapsed else 0.0
+
+
+    def progress(self, force: bool = False):
+        "Print a progress line if it's been long enough since the last one"
+        now = time.time()
+        if not force and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        for name, func in self.probes.items():
+            self.gauge(name, func())
+        elapsed = now - self.start
+        frames = self.counters.get('frames', 0)
+        fps = frames / elapsed if elapsed else 0
+        line = [f"{frames}" + (f"/{self.total_frames} frames ({100 * frames / self.total_frames:0.1f}%)"
+                               if self.total_frames else " frames"),
+                f"{fps:0.1f} fps"]
+        if self.total_frames and fps:
+            line.append(f"ETA {time.strftime('%H:%M:%S', time.gmtime(max(0, self.total_frames - frames) / fps))}")
+        if 'annotate' in self.histograms:
+            line.append(f"annotate {1000 * self.histograms['annotate'].mean:0.1f}ms/frame")
+            line.append(f"workers {100 * self.utilization(elapsed):0.0f}% busy")
+        if self.gauges:
+            line.append("queues " + ' '.join([f"{k} {g.last}" for k, g in self.gauges.items()]))
+        print(", ".join(line), flush=True)
+
+
+    def summary(self) -> dict:
+        elapsed = time.time() - self.start
+        frames = self.counters.get('frames', 0)
+        return {'elapsed': elapsed,
+                'frames': frames,
+                'fps': frames / elapsed if elapsed else 0,
+                'workers': self.workers,
+                'worker_utilization': self.utilization(elapsed),
+                'counters': dict(self.counters),
+                'latency': {k: v.summary() for k, v in self.histograms.items()},
+                'queues': {k: v.summary() for k, v in self.gauges.items()}}
+
+
+    def write(self, filename: str):
+        "Write the summary as JSON"
+        with open(filename, "w") as f:
+            json.dump(self.summary(), f, indent=2)
@@ -0,0 +1,148 @@
+#!/bin/env python3
+#
+# Everything the renderer needs to know about a video from one ffprobe
+# run:  the exact frame rate, the dimensions (after any rotation, like
+# ffmpeg decodes it), the number of frames, the keyframes and the audio
+# streams.  Counting frames and finding keyframes means ffprobe has to
+# read every packet in the file, so the results are cached on disk, keyed
+# by the file's path, size and modification time.
+#
+# Run it directly to see what it finds for a file.
+#
+
+import argparse
+from fractions import Fraction
+import hashlib
+import json
+import os
+from pathlib import Path
+import subprocess
+from pydantic import BaseModel
+
+CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME') or Path('~/.cache').expanduser(), 'annotate_video', 'probe')
+
+
+class AudioStream(BaseModel):
+    """An audio stream in the file"""
+    index: int
+    codec: str
+    sample_rate: int
+    channels: int
+
+
+class VideoInfo(BaseModel):
+    """What ffprobe knows about a video"""
+    filename: str
+    size: int
+    mtime_ns: int
+    format: str
+    codec: str
+    width: int
+    height: int
+    rotation: int  # degrees, already applied to the width and height
+    pix_fmt: str
+    fps: str  # a rational, like 30000/1001, which ffmpeg takes as-is
+    frames: int
+    duration: float
+    keyframes: list[int]  # numbered from 1, like the frames
+    audio: list[AudioStream]
+
+    @property
+    def rate(self) -> Fraction:
+        return Fraction(self.fps)
+
+
+def rotation(stream: dict) -> int:
+    "How far the picture is rotated when it's shown (and when ffmpeg decodes it)"
+    for sd in stream.get('side_data_list', []):
+        if 'rotation' in sd:
+            return round(float(sd['rotation']))
+    # older ffmpeg puts it in the tags
+    return round(float(stream.get('tags', {}).get('rotate', 0)))
+
+
+def run_ffprobe(filename: str) -> VideoInfo:
+    "Probe a file, reading every packet"
+    p = subprocess.run(['ffprobe', '-v', 'error', '-of', 'json', '-show_format', '-show_streams',
+                        '-show_entries', 'packet=stream_index,pts,flags', filename],
+                       stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, encoding='utf-8', check=True)
+    data = json.loads(p.stdout)
+    video = [s for s in data['streams'] if s['codec_type'] == 'video']
+    if not video:
+        raise ValueError(f"{filename} doesn't have a video stream")
+    video = video[0]
+    fps = video.get('avg_frame_rate', '0/0')
+    if fps.endswith('/0') or fps.startswith('0/'):
+        # variable rate or unknown, so use the base rate
+        fps = video['r_frame_rate']
+
+    # packets come in decode order and keyframes are counted in
+    # presentation order, unless the container doesn't have timestamps.
+    packets = [(p.get('pts', i), 'K' in p.get('flags', ''))
+               for i, p in enumerate(data.get('packets', [])) if p['stream_index'] == video['index']]
+    packets.sort()
+
+    # ffmpeg rotates the frames as it decodes them, so a portrait phone
+    # video comes out taller than it's stored.
+    width, height = video['width'], video['height']
+    rotate = rotation(video)
+    if rotate % 180:
+        width, height = height, width
+
+    st = os.stat(filename)
+    return VideoInfo(filename=os.path.abspath(filename), size=st.st_size, mtime_ns=st.st_mtime_ns,
+                     format=data['format'].get('format_name', ''),
+                     codec=video.get('codec_name', ''),
+                     width=width, height=height, rotation=rotate,
+                     pix_fmt=video.get('pix_fmt', ''),
+                     fps=str(Fraction(fps)),
+                     frames=len(packets),
+                     duration=float(data['format'].get('duration', 0)),
+                     keyframes=[i + 1 for i, (_, key) in enumerate(packets) if key],
+                     audio=[AudioStream(index=s['index'], codec=s.get('codec_name', ''),
+                                        sample_rate=int(s.get('sample_rate', 0)),
+                                        channels=s.get('channels', 0))
+                            for s in data['streams'] if s['codec_type'] == 'audio'])
+
+
+def probe(filename: str, cache_dir: Path | None = CACHE_DIR) -> VideoInfo:
+    "Probe a file, using the cached results if the file hasn't changed"
+    st = os.stat(filename)
+    cachefile = None
+    if cache_dir is not None:
+        key = hashlib.sha256(os.path.abspath(filename).encode('utf-8')).hexdigest()
+        cachefile = Path(cache_dir, key + ".json")
+        if cachefile.exists():
+            try:
+                info = VideoInfo.model_validate_json(cachefile.read_text())
+                if info.size == st.st_size and info.mtime_ns == st.st_mtime_ns:
+                    return info
+            except ValueError:
+                # an old or broken cache entry is just a miss
+                pass
+
+    info = run_ffprobe(filename)
+    if cachefile is not None:
+        try:
+            cachefile.parent.mkdir(parents=True, exist_ok=True)
+            partial = cachefile.with_suffix(f".{os.getpid()}.partial")
+            partial.write_text(info.model_dump_json())
+            os.replace(partial, cachefile)
+        except OSError as e:
+            print(f"Cannot cache the probe for {filename}: {e}")
+    return info
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Probe videos")
+    parser.add_argument("videos", nargs='+', help="Video files")
+    parser.add_argument("--no-cache", action='store_true', help="Don't use or update the probe cache")
+    args = parser.parse_args()
+    for v in args.videos:
+        info = probe(v, None if args.no_cache else CACHE_DIR)
+        print(info.model_dump_json(indent=2, exclude={'keyframes'}))
+        print(f"  {len(info.keyframes)} keyframes")
+
+
+if __name__ == "__main__":
+    main()
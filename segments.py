@@ -0,0 +1,212 @@
+#!/bin/env python3
+#
+# Split a video into segments which are decoded, annotated and encoded
+# independently in their own processes, then joined back together with
+# the concat demuxer without re-encoding.  Segments are cut at keyframes
+# so every one of them starts cleanly from a seek and, when there's shot
+# data from scenedetect or Rekognition, at a shot boundary near the
+# ideal cut point so the seams land where the picture changes anyway.
+#
+# With a cache directory, every rendered segment is kept under a hash of
+# everything that went into it:  the source frames, the resolved zone
+# layout and styles, and the annotations which fall in the segment.  A
+# rerun only renders the segments whose inputs changed.
+#
+
+import hashlib
+import multiprocessing
+import os
+from pathlib import Path
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import yaml
+from yaml import CSafeLoader as Loader
+from annotate_video import (Annotate, AnnotationConfig, BaseAnnotation, Style, Zone, ZoneConfig,
+                            annotate_raw, report, text_sprites)
+from ffmpeg_pipe import FrameDecoder, FrameEncoder, audio_args
+from metrics import Metrics
+import probe
+
+
+def shot_boundaries(filename: str) -> list[int]:
+    "Get the first frame (numbered from 1) of every shot in scenedetect or Rekognition output"
+    with open(filename) as f:
+        data = yaml.load(f, Loader=Loader)
+    if 'scenes' in data:
+        return sorted({s['start_frame'] + 1 for s in data['scenes']})
+    if 'Segments' in data:
+        return sorted({s['StartFrameNumber'] + 1 for s in data['Segments'] if s['Type'] == 'SHOT'})
+    raise ValueError(f"{filename} isn't scenedetect or Rekognition shot data")
+
+
+def plan_segments(frames: int, count: int, keyframes: list[int], shots: list[int] = ()) -> list[tuple[int, int]]:
+    """Split frames into about count (start, end) segments, cutting at
+       keyframes and preferring keyframes which start a shot"""
+    keyframes = sorted(keyframes) or list(range(1, frames + 1))
+    preferred = sorted(set(keyframes) & set(shots))
+    slack = frames / count / 4
+    cuts = [1]
+    for i in range(1, count):
+        ideal = 1 + i * frames / count
+        choices = [x for x in preferred if abs(x - ideal) <= slack] or keyframes
+        best = min(choices, key=lambda x: abs(x - ideal))
+        # short videos with few keyframes get fewer segments
+        if best > cuts[-1]:
+            cuts.append(best)
+    return [(start, end - 1) for start, end in zip(cuts, cuts[1:] + [frames + 1])]
+
+
+# bump this when a change to the rendering makes the cached segments stale
+CACHE_VERSION = 1
+
+
+def style_key(style: Style) -> tuple:
+    return (tuple(style.foreground), tuple(style.background), style.border,
+            style.font.path, style.font.size)
+
+
+def layout_key(zc: ZoneConfig) -> tuple:
+    "The zone geometry and styles, after they've been laid out"
+    return (tuple([(zn, z.title, z.x, z.y, z.w, z.h, style_key(z.style)) for zn, z in zc.zones.items()]),
+            tuple([(sn, style_key(s)) for sn, s in zc.styles.items()]))
+
+
+def annotation_key(a: BaseAnnotation, first: int, last: int) -> tuple:
+    "What an annotation draws between first and last"
+    fields = []
+    for k, v in a.__dict__.items():
+        if k in ('start_frame', 'end_frame'):
+            # only the part of a span inside the segment matters
+            v = max(first, v) if k == 'start_frame' else min(last, v)
+        elif isinstance(v, Style):
+            v = style_key(v)
+        elif isinstance(v, Zone):
+            v = (v.x, v.y, v.w, v.h)
+        fields.append((k, v))
+    return (type(a).__name__, tuple(fields))
+
+
+def segment_key(anno: Annotate, inputvideo: str, fps: str, start: int, end: int,
+                count: int | None, suffix: str) -> str:
+    "Hash everything which goes into rendering a segment"
+    h = hashlib.sha256()
+    def add(x):
+        h.update(repr(x).encode('utf-8'))
+        h.update(b'\0')
+
+    st = os.stat(inputvideo)
+    add((CACHE_VERSION, os.path.abspath(inputvideo), st.st_size, st.st_mtime_ns,
+         str(fps), start, count, suffix, anno.content_size))
+    add(layout_key(anno.zc))
+    shard = anno.shard(start, end)
+    for a in shard.spans:
+        add(annotation_key(a, start, end))
+    for t in shard.tracks:
+        add(annotation_key(t, start, end))
+    for k in sorted(shard.annotations):
+        for a in shard.annotations[k]:
+            add((k, annotation_key(a, start, end)))
+    for store in anno.stores:
+        for r in store.rows_between(start, end):
+            add((max(start, store.cols['start'][r]), min(end, store.cols['end'][r]),
+                 annotation_key(store.build(r), start, end)))
+    return h.hexdigest()
+
+
+def render_segment(zoneconfig: ZoneConfig, width: int, height: int, stores: list[str],
+                   shard: AnnotationConfig, inputvideo: str, fps: str,
+                   start: int, count: int | None, filename: str) -> tuple[int, int, list[float]]:
+    """Decode, annotate and encode one segment in this process.  Returns the
+       text sprite cache (hits, misses) and the seconds spent annotating
+       each frame"""
+    import annotation_store
+    anno = Annotate(zoneconfig, width, height)
+    for s in stores:
+        anno.add_store(annotation_store.AnnotationStore(s))
+    anno.set_annotations(shard)
+    hits, misses = text_sprites.hits, text_sprites.misses
+    seconds = []
+    with FrameDecoder(inputvideo, width, height, fps, start=start, count=count) as decoder, \
+         FrameEncoder(filename, anno.width, anno.height, fps) as encoder:
+        for framenum, data in decoder:
+            t = time.time()
+            frame = annotate_raw(anno, framenum, data)
+            seconds.append(time.time() - t)
+            encoder.write(frame)
+    return text_sprites.hits - hits, text_sprites.misses - misses, seconds
+
+
+def join(pieces: list[str], audio_source: str, outputvideo: str, workdir: str):
+    "Concatenate the rendered segments without re-encoding and put the audio back"
+    concat = Path(workdir, "segments.ffconcat")
+    with open(concat, "w") as f:
+        f.write("ffconcat version 1.0\n")
+        for p in pieces:
+            p = p.replace("'", "'\\''")
+            f.write(f"file '{p}'\n")
+    subprocess.run(['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', str(concat),
+                    '-i', audio_source, '-map', '0:v', '-map', '1:a?',
+                    '-c:v', 'copy', *audio_args(audio_source, outputvideo), outputvideo],
+                   check=True, stdin=subprocess.DEVNULL)
+
+
+def render(args, zconf: ZoneConfig, anno: Annotate, fps: str):
+    "Render the video as segments in parallel, reusing cached segments when possible"
+    width, height = anno.content_size
+    info = probe.probe(args.inputvideo)
+    frames, keyframes = info.frames, info.keyframes
+    shots = shot_boundaries(args.shots) if args.shots else []
+    plan = plan_segments(frames, args.segments, keyframes, shots)
+    workers = min(args.workers or os.cpu_count(), len(plan))
+    suffix = Path(args.outputvideo).suffix
+    if args.cache:
+        Path(args.cache).mkdir(parents=True, exist_ok=True)
+    print(f"Rendering {frames} frames as {len(plan)} segments with {workers} workers")
+
+    with tempfile.TemporaryDirectory() as tmpdir, \
+         ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as ppe:
+        # (future, file being written, final file)
+        jobs = []
+        pieces = []
+        to_render = 0
+        for i, (start, end) in enumerate(plan):
+            # the last segment runs to the end, whatever the packet count said
+            count = end - start + 1 if i < len(plan) - 1 else None
+            if args.cache:
+                key = segment_key(anno, args.inputvideo, fps, start, end, count, suffix)
+                filename = str(Path(args.cache, key + suffix).absolute())
+                pieces.append(filename)
+                if os.path.exists(filename):
+                    continue
+                # an interrupted render must never look like a finished one
+                partial = str(Path(args.cache, key + '.partial' + suffix).absolute())
+            else:
+                filename = partial = str(Path(tmpdir, f"segment-{i:05d}{suffix}"))
+                pieces.append(filename)
+            future = ppe.submit(render_segment, zconf, width, height,
+                                [x.filename for x in anno.stores], anno.shard(start, end),
+                                args.inputvideo, fps, start, count, partial)
+            jobs.append((future, partial, filename))
+            to_render += end - start + 1
+        if args.cache:
+            print(f"{len(plan) - len(jobs)} of {len(plan)} segments are cached")
+
+        # segments report back when they're finished, so the progress
+        # lines come once per segment at most.
+        metrics = Metrics(to_render, workers, args.progress_interval)
+        for i, (future, partial, filename) in enumerate(jobs):
+            hits, misses, seconds = future.result()
+            metrics.count('frames', len(seconds))
+            metrics.count('segments')
+            metrics.count('sprite_hits', hits)
+            metrics.count('sprite_misses', misses)
+            metrics.observe_many('annotate', seconds)
+            if partial != filename:
+                os.replace(partial, filename)
+            print(f"Segment {i + 1} of {len(jobs)} is done")
+            metrics.progress()
+        join(pieces, args.inputvideo, args.outputvideo, tmpdir)
+
+    report(metrics, args.metrics)